@@ -7,6 +7,8 @@ import time
 import math
 from datetime import datetime, date
 
+from xoxo.geo import greate_circle_distance, path_length
+
 class CellMap(object):
     def __init__(self, data):
         self._map = {}
@@ -76,16 +78,7 @@ def extract_metaflow(loc):
 def calculate_gcd(latlon1, latlon2):
     """ Calculate great circle distance
     """
-    lon1 = math.radians(latlon1[1])
-    lat1 = math.radians(latlon1[0])
-    lon2 = math.radians(latlon2[1])
-    lat2 = math.radians(latlon2[0])
-    dlon = lon2 - lon1
-    dlat = lat2 - lat1
-    a = (math.sin(dlat / 2))**2 + math.cos(lat1) * math.cos(lat2) * (math.sin(dlon / 2))**2
-    c = 2 * math.asin(min(1, math.sqrt(a)))
-    dist = 6371 * c
-    return dist
+    return greate_circle_distance(latlon1[1], latlon1[0], latlon2[1], latlon2[0])
 
 def calculate_mp(lats, lons, w=None):
     if w is None:
@@ -111,15 +104,11 @@ def calculate_mp(lats, lons, w=None):
 def calculate_rg(lats, lons):
     """ Calculate the radius of gyration
     """
-    dist = []
     latlons = set(zip(lats, lons))
     lats = [ i[0] for i in latlons ]
     lons = [ i[1] for i in latlons ]
     lat_d, lon_d = calculate_mp(lats, lons)
-    for i in range(0, len(lons)):
-        gcd = calculate_gcd((lat_d, lon_d), (lats[i], lons[i]))
-        dist.append(gcd)
-    dist = np.array(dist)
+    dist = greate_circle_distance(lon_d, lat_d, lons, lats)
     rg = np.sqrt(np.sum(dist**2) / len(dist))
     return rg
 
@@ -163,15 +152,12 @@ def extract_metaflow_features(ts, locs, flows):
         flow_ts = ts[ flow[0]:flow[1]+1 ]
         flow_lons = lons[ flow[0]:flow[1]+1 ]
         flow_lats = lats[ flow[0]:flow[1]+1 ]
-        flow_dists = [ calculate_gcd((flow_lats[i], flow_lons[i]),
-                                     (flow_lats[i+1], flow_lons[i+1]))
-                       for i in range(0, len(flow_locs)-1) ]
 
         ff_id += 1
         ff_len = len(flow_locs)
         ff_ulen = len(set(flow_locs))
         ff_time = max(flow_ts) - min(flow_ts)
-        ff_dist = sum(flow_dists)
+        ff_dist = path_length(zip(flow_lons, flow_lats))
         ff_ismax = is_max_metaflow(flow, flows, ff_len)
         ff_rg = calculate_rg(flow_lats, flow_lons)
         ff_rgprc = 1.0 * ff_rg / rg_day
@@ -3,30 +3,99 @@
 # Extract and analyze the mobility Mesos using Apache Spark.
 import sys
 import os
+import json
 
 from pyspark import SparkContext, SparkConf
 
-from xoxo.bsmap import BaseStationMap
 from xoxo.permov import movement_reader
 from xoxo.settings import BSMAP
 from xoxo.utils import zippylib
+from xoxo.resources import ship_file, shared_bsmap, parse_records, sort_by_user, sorted_records
+from xoxo.sketch import HyperLogLog
 
 __author__ = 'Xiaming Chen'
 __email__ = 'chen@xiaming.me'
 
 
-def record_splitter(r):
-    uid, ts, bid = r.strip('\r\n ').split(',')
-    return (int(uid), float(ts), int(bid))
-
-def mobility_graphs(logiter, bsmap, roadnet):
-    results = []
-    for person in movement_reader(logiter, bsmap):
-        graph = person.convert2graph(roadnet, True)
-        nlen = len(graph.nodes())
+class HzSummary(object):
+    """ Mergeable totals of records, stations, mobility graphs and users,
+    overall and per number of graph nodes.
+
+    Distinct stations are estimated with a HyperLogLog sketch of the given
+    precision. Users are counted exactly where their run of graphs starts,
+    so partial summaries only add up when no user is split among them, as
+    with the partitions of `sort_by_user`.
+    """
+    def __init__(self, precision=14):
+        self.records = 0
+        self.stations = HyperLogLog(precision)
+        self._bids = []
+        self.graphs = 0
+        self.users = 0
+        self.groups = {}        # node number -> [users, graphs]
+        self._last = None
+        self._last_in = {}
+
+    def add_record(self, record):
+        self.records += 1
+        self._bids.append(record[2])
+        if len(self._bids) >= 65536:
+            self._flush()
+        return record
+
+    def _flush(self):
+        self.stations.update(self._bids)
+        self._bids = []
+
+    def add_graph(self, uid, nlen):
+        self.graphs += 1
+        if uid != self._last:
+            self.users += 1
+            self._last = uid
+        group = self.groups.setdefault(nlen, [0, 0])
+        group[1] += 1
+        if self._last_in.get(nlen) != uid:
+            group[0] += 1
+            self._last_in[nlen] = uid
+
+    def merge(self, other):
+        self._flush()
+        other._flush()
+        self.records += other.records
+        self.stations.merge(other.stations)
+        self.graphs += other.graphs
+        self.users += other.users
+        for nlen, (users, graphs) in other.groups.items():
+            group = self.groups.setdefault(nlen, [0, 0])
+            group[0] += users
+            group[1] += graphs
+        return self
+
+    def to_dict(self):
+        self._flush()
+        return {
+            'totalrecords': self.records,
+            'totalbs': self.stations.count(),
+            'totalmgs': self.graphs,
+            'totalusers': self.users,
+            'groupstat': [{'nodes': nlen, 'users': users, 'graphs': graphs}
+                          for nlen, (users, graphs) in sorted(self.groups.items())],
+        }
+
+
+def partition_summary(pairs, bsmap):
+    """ Summary of one partition of `sort_by_user`; mobility graphs of more
+    than one node are counted by their number of distinct locations.
+    """
+    summary = HzSummary()
+    records = (summary.add_record(r) for r in sorted_records(pairs))
+    for person in movement_reader(records, shared_bsmap(bsmap)):
+        nlen = len(set(person.coordinates))
         if nlen > 1:
-            results.append((person.id, person.dtstart, nlen, graph))
-    return results
+            summary.add_graph(person.id, nlen)
+    summary._flush()
+    return [summary]
+
 
 def main(sc):
     if len(sys.argv) < 3:
@@ -37,28 +106,17 @@ def main(sc):
     movDataRDD = sc.textFile(sys.argv[1])
     output = sys.argv[2]
 
-    bsmap = BaseStationMap(BSMAP)
-
-    movDataRDD = movDataRDD.map(lambda x: record_splitter(x))
-
-    sc.parallelize([movDataRDD.count()], 1).saveAsTextFile(os.path.join(output, 'totalrecords'))
-
-    sc.parallelize([movDataRDD.map(lambda x: x[2]).distinct().count()], 1).saveAsTextFile(os.path.join(output, 'totalbs'))
-
-    # Extract mobility graphs
-    mobgraphRDD = movDataRDD.groupBy(lambda x: x[0]).flatMap(lambda x: mobility_graphs(x[1], bsmap, None))
-
-    sc.parallelize([mobgraphRDD.count()], 1).saveAsTextFile(os.path.join(output, 'totalmgs'))
+    bsmap = ship_file(sc, BSMAP)
 
-    sc.parallelize([mobgraphRDD.map(lambda x: x[0]).distinct().count()], 1).saveAsTextFile(os.path.join(output, 'totalusers'))
+    movDataRDD = movDataRDD.mapPartitions(parse_records)
 
-    def group_stat(mgiter):
-        totalusers = len(set([i[0] for i in mgiter]))
-        totalgraphs = len([i[3] for i in mgiter])
-        return (totalusers, totalgraphs)
+    # All statistics in one pass over the user-sorted records
+    summary = sort_by_user(movDataRDD)\
+        .mapPartitions(lambda x: partition_summary(x, bsmap))\
+        .reduce(lambda a, b: a.merge(b))
 
-    mobgraphRDD.groupBy(lambda x: x[2]).mapValues(lambda x: group_stat(x))\
-        .saveAsTextFile(os.path.join(output, 'groupstat'))
+    sc.parallelize([json.dumps(summary.to_dict(), sort_keys=True)], 1)\
+        .saveAsTextFile(os.path.join(output, 'summary'))
 
 
 if __name__ == '__main__':
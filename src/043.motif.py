@@ -2,100 +2,168 @@
 # -*- encoding: utf-8
 # Extract and analyze the movement motif.
 import os
+from multiprocessing import Pool, cpu_count
 
-import networkx as nx
 import numpy as np
+import matplotlib
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 
 from xoxo.bsmap import BaseStationMap
 from xoxo.permov import movement_reader
-from xoxo.utils import seq2graph, draw_network
-from xoxo.settings import BSMAP, MOVEMENT_DAT, MAX_USER_NUM
-from xoxo.motif import Motif
+from xoxo.utils import draw_network
+from xoxo.settings import BSMAP, MOVEMENT_DAT, MAX_USER_NUM, DEBUGGING
+from xoxo.motif import Motif, MotifLayouts, motif_graph, motif_catalogue, CATALOGUE_MAX_NODES
+from xoxo.mobgraph import MobGraph
 
 __author__ = 'Xiaming Chen'
 __email__ = 'chen@xiaming.me'
 
 
-if __name__ == '__main__':
+def user_chunks(movement, nchunk):
+    """ Split a movement file into byte ranges (start, end) that do not
+    break the records of one user apart.
+    """
+    size = os.path.getsize(movement)
+    ifile = open(movement, 'rb')
+    bounds = [0]
+    for i in range(1, nchunk):
+        ifile.seek(max(size * i // nchunk, bounds[-1]))
+        ifile.readline()    # skip the partial line
+        uid = ifile.readline().split(',', 1)[0]
+        while True:
+            pos = ifile.tell()
+            line = ifile.readline()
+            if not line or line.split(',', 1)[0] != uid:
+                break
+        if bounds[-1] < pos < size:
+            bounds.append(pos)
+    ifile.close()
+    bounds.append(size)
+    return zip(bounds[:-1], bounds[1:])
+
+
+def read_range(movement, start, end):
+    ifile = open(movement, 'rb')
+    ifile.seek(start)
+    while ifile.tell() < end:
+        line = ifile.readline()
+        if not line:
+            break
+        yield line
+    ifile.close()
 
-    class IdCounter(object):
-        ids = set()
-        @staticmethod
-        def count(new_id):
-            IdCounter.ids.add(new_id)
-            return len(IdCounter.ids)
 
-    counter = MAX_USER_NUM
+def count_motifs(movement, basemap, start=0, end=None, max_users=MAX_USER_NUM):
+    """ Count the motifs of users whose records lie in the byte range
+    [start, end) of the movement file.
+    """
+    if end is None:
+        end = os.path.getsize(movement)
+    users = set()
+    motifrepo = Motif()
+    for person in movement_reader(read_range(movement, start, end), BaseStationMap(basemap)):
+        users.add(person.id)
+        if len(users) > max_users:
+            break
+        motifrepo.add_graph(MobGraph.from_sequence(person.locations))
+    return motifrepo
+
+
+def _count_motifs_star(args):
+    return count_motifs(*args)
+
+
+def count_motifs_parallel(movement, basemap, nproc=None):
+    """ Count motifs with a process pool over user-aligned file chunks and
+    merge the partial counters.
+    """
+    nproc = nproc or cpu_count()
+    chunks = user_chunks(movement, nproc)
+    # Build the lookup tables before forking so workers inherit them
+    for n in range(1, CATALOGUE_MAX_NODES + 1):
+        motif_catalogue(n)
+    pool = Pool(nproc)
+    try:
+        parts = pool.map(_count_motifs_star, [(movement, basemap, s, e) for s, e in chunks])
+    finally:
+        pool.close()
+        pool.join()
+    return reduce(lambda a, b: a.merge(b), parts, Motif())
+
+
+def render_motifs(page):
+    """ Render one page of motifs, given as (path, figsize, [(key, layout,
+    title)]), into a file.
+    """
+    path, figsize, motifs = page
+    ncol = 5
+    nrow = np.ceil(1.0 * len(motifs) / ncol)
+
+    plt.figure(figsize=figsize)
+    for i in range(len(motifs)):
+        key, pos, title = motifs[i]
+        plt.subplot(nrow, ncol, i+1)
+        ax=plt.gca()
+        draw_network(motif_graph(key), pos, ax)
+        ax.autoscale()
+        plt.axis('equal')
+        plt.axis('off')
+        plt.title(title)
+
+    plt.savefig(path)
+    plt.close()
+
+
+if __name__ == '__main__':
+
     basemap = BSMAP
     movement = MOVEMENT_DAT
 
     print("Extracting motifs ...")
-    motifrepo = Motif()
-    for person in movement_reader(open(movement, 'rb'), BaseStationMap(basemap)):
-
-        if IdCounter.count(person.id) > counter:
-            break
-
-        user_graph = seq2graph(person.locations, True)
-        motifrepo.add_graph(user_graph)
+    if DEBUGGING:
+        motifrepo = count_motifs(movement, basemap)
+    else:
+        motifrepo = count_motifs_parallel(movement, basemap)
 
     motifrepo.stat().to_csv('motifs_stat.csv', index=False)
+    with open('motifs_counts.csv', 'wb') as ofile:
+        motifrepo.dump_counts(ofile)
 
     print("Plotting motifs ...")
     motif_filter = range(3, 11)
+    pages = []
 
     # Global stat
-    all_motifs = motifrepo.all_motifs(motif_filter, True, True)
+    all_motifs = sorted(motifrepo.key_iter(motif_filter), key=lambda x: x[1], reverse=True)
     totmotif = motifrepo.number_of_motifs(motif_filter)
-    percs = [(motif, 1.0*count/totmotif) for (motif, count) in all_motifs]
+    percs = [(key, 1.0*count/totmotif) for (key, count) in all_motifs]
     percs = [i for i in percs if i[1] >= 0.003]
-
-    ncol = 5
-    nrow = np.ceil(1.0 * len(percs) / ncol)
-
-    plt.figure(figsize=(12, 20))
-    for i in range(len(percs)):
-        motif = percs[i][0]
-        perc = percs[i][1]
-        plt.subplot(nrow, ncol, i+1)
-        ax=plt.gca()
-        pos=nx.spring_layout(motif)
-        draw_network(motif, pos, ax)
-        ax.autoscale()
-        plt.axis('equal')
-        plt.axis('off')
-        plt.title('%.1f%%, nn=%d' % (perc * 100, motif.number_of_nodes()))
-
-    if not os.path.exists('motifs'):
-        os.mkdir('motifs')
-    plt.savefig('motifs/motif-all.pdf')
+    pages.append(('motifs/motif-all.pdf', (12, 20),
+                  [(key, '%.1f%%, nn=%d' % (perc * 100, key[1])) for key, perc in percs]))
 
     # Stat by motif length
     for nn in motif_filter:
         total = motifrepo.number_of_motifs(nn)
-        percs = [(motif, 1.0*count/total) for (motif, count) in motifrepo.motif_iter(nn)]
+        if total == 0:
+            continue
+        percs = [(key, 1.0*count/total) for (key, count) in motifrepo.key_iter(nn)]
         percs = sorted(percs, key=lambda x: x[1], reverse=True)
         percs = [i for i in percs if i[1] >= 0.015]
+        pages.append(('motifs/motif-%d.pdf' % nn, (12, 12),
+                      [(key, '%.1f%%' % (perc * 100)) for key, perc in percs]))
 
-        ncol = 5
-        nrow = np.ceil(1.0 * len(percs) / ncol)
-
-        # visualizing motifs
-        plt.figure(figsize=(12, 12))
-        for i in range(len(percs)):
-            motif = percs[i][0]
-            perc = percs[i][1]
-            plt.subplot(nrow, ncol, i+1)
-            ax=plt.gca()
-            pos=nx.spring_layout(motif)
-            draw_network(motif, pos, ax)
-            ax.autoscale()
-            plt.axis('equal')
-            plt.axis('off')
-            plt.title('%.1f%%' % (perc * 100))
-
-        if not os.path.exists('motifs'):
-            os.mkdir('motifs')
-        plt.savefig('motifs/motif-%d.pdf' % nn)
+    # Lay out every motif once, then render pages in parallel
+    layouts = MotifLayouts()
+    pages = [(path, figsize, [(key, layouts.get(key), title) for key, title in motifs])
+             for path, figsize, motifs in pages]
+    layouts.save()
 
+    if not os.path.exists('motifs'):
+        os.mkdir('motifs')
+    pool = Pool(1 if DEBUGGING else cpu_count())
+    try:
+        pool.map(render_motifs, pages)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# Count movement motifs in parallel using Apache Spark.
+import sys
+import os
+
+from pyspark import SparkContext, SparkConf
+
+from xoxo.permov import movement_reader
+from xoxo.motif import Motif
+from xoxo.mobgraph import MobGraph
+from xoxo.utils import zippylib
+from xoxo.resources import ship_file, shared_bsmap, parse_records, sort_by_user, sorted_records
+
+__author__ = 'Xiaming Chen'
+__email__ = 'chen@xiaming.me'
+
+
+def partition_motifs(pairs, bsmap):
+    """ Count the motifs of all users in one partition of `sort_by_user`
+    """
+    motifrepo = Motif()
+    for person in movement_reader(sorted_records(pairs), shared_bsmap(bsmap)):
+        motifrepo.add_graph(MobGraph.from_sequence(person.locations))
+    yield motifrepo
+
+
+def main(sc):
+    if len(sys.argv) < 4:
+        print >> sys.stderr, "Usage: motif-spark <movdata> <bsmap> <output>"
+        exit(-1)
+
+    movDataRDD = sc.textFile(sys.argv[1])
+    bsmap = ship_file(sc, sys.argv[2])
+    output = sys.argv[3]
+
+    motifrepo = sort_by_user(movDataRDD.mapPartitions(parse_records))\
+        .mapPartitions(lambda x: partition_motifs(x, bsmap))\
+        .reduce(lambda a, b: a.merge(b))
+
+    motifrepo.stat().to_csv(output, index=False)
+
+
+if __name__ == '__main__':
+    APP_NAME = "MotifSparkJob"
+    conf = SparkConf().setAppName(APP_NAME)
+    sc = SparkContext(conf=conf)
+    thisdir = os.path.dirname(__file__)
+
+    # add external python libraries
+    xoxoZip = zippylib(os.path.join(thisdir, 'xoxo'))
+    sc.addPyFile(xoxoZip)
+
+    main(sc)
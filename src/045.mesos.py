@@ -7,26 +7,21 @@ from ctypes import addressof
 
 from pyspark import SparkContext, SparkConf
 
-from xoxo.roadnet import RoadNetwork
-from xoxo.bsmap import BaseStationMap
 from xoxo.permov import movement_reader
 from xoxo.settings import HZ_ROADNET
-from xoxo.utils import zippylib, dumps_mobgraph, loads_mobgraph
+from xoxo.utils import zippylib, dumps_mobgraph, loads_mobgraph, dumpb_mobgraph, loadb_mobgraph
 from xoxo.mesos import Mesos
+from xoxo.resources import ship_file, shared_bsmap, shared_roadnet, parse_records, \
+    sort_by_user, sorted_records
 
 __author__ = 'Xiaming Chen'
 __email__ = 'chen@xiaming.me'
 
 
-def record_splitter(r):
-    uid, ts, bid = r.strip('\r\n ').split(',')
-    return (int(uid), float(ts), int(bid))
-
-
 def gen_mesos(lg1, lg2):
     uid1, ts1, grp, g1 = lg1
     uid2, ts2, grp, g2 = lg2
-    mesos = Mesos(g1, g2)
+    mesos = Mesos(loadb_mobgraph(g1), loadb_mobgraph(g2))
     return (grp, mesos.struct_dist(), mesos.mesos, uid1, uid2, ts1, ts2)
 
 
@@ -54,9 +49,10 @@ def loads_mesos(S):
 
 
 def mobility_graphs(logiter, bsmap, roadnet, cmin=2, cmax=15, dates=None):
-    """ Extract mobility graphs from a list of movement observations
+    """ Extract mobility graphs from a stream of movement observations
+    ordered by user and time. Graphs are binary encoded to keep shuffled
+    and cached records small.
     """
-    results = []
     for person in movement_reader(logiter, bsmap):
         if person.which_day() not in dates:
             continue
@@ -65,12 +61,19 @@ def mobility_graphs(logiter, bsmap, roadnet, cmin=2, cmax=15, dates=None):
         if nloc > cmax or nloc < cmin:
             continue
 
-        graph = person.convert2graph(roadnet)
-        nlen = len(graph.nodes())
+        graph = person.convert2mobgraph(roadnet)
+        nlen = graph.number_of_nodes()
         if nlen > 1:
-            results.append((person.id, person.dtstart, nlen, graph))
+            yield (person.id, person.dtstart, nlen, dumpb_mobgraph(graph))
 
-    return results
+
+def partition_graphs(pairs, bsmap, roadnet, dates):
+    """ Mobility graphs of all users in one partition of `sort_by_user`.
+    The station map and road network are given by shipped file names and
+    loaded once per executor process.
+    """
+    return mobility_graphs(sorted_records(pairs), shared_bsmap(bsmap),
+                           shared_roadnet(roadnet), dates=dates)
 
 
 def main(sc):
@@ -84,17 +87,16 @@ Usage: mesos-spark <movdata> <bsmap> <output> <dates>
 
     # Read movement records
     movDataRDD = sc.textFile(sys.argv[1])
-    bsmap = BaseStationMap(sys.argv[2])
+    bsmap = ship_file(sc, sys.argv[2])
     output = sys.argv[3]
     dates = sys.argv[4].split(',')
 
-    roadnet = RoadNetwork(HZ_ROADNET)
+    # Use ship_file(sc, HZ_ROADNET) to weight edges by road distance
     roadnet = None
 
     # Extract mobility graphs
-    mobgraphRDD = movDataRDD.map(lambda x: record_splitter(x))\
-        .groupBy(lambda x: x[0])\
-        .flatMap(lambda x: mobility_graphs(x[1], bsmap, roadnet, dates=dates))\
+    mobgraphRDD = sort_by_user(movDataRDD.mapPartitions(parse_records))\
+        .mapPartitions(lambda x: partition_graphs(x, bsmap, roadnet, dates))\
         .cache()
 
     groups = mobgraphRDD.groupBy(lambda x: x[2]).collect()
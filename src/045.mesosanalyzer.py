@@ -5,13 +5,13 @@ import os
 import numpy as np
 import networkx as nx
 import matplotlib.pyplot as plt
-from networkx.drawing.nx_pylab import draw_networkx
 
 from xoxo.bsmap import BaseStationMap
 from xoxo.permov import movement_reader
 from xoxo.mesos import Mesos
+from xoxo.motif import MotifLayouts, canonical_form, motif_graph
 from networkx.algorithms import isomorphism
-from xoxo.utils import dumps_mobgraph, loads_mobgraph, draw_network
+from xoxo.utils import dumpb_mobgraphs, loadb_mobgraphs, draw_network
 
 __author__ = 'Xiaming Chen'
 __email__ = 'chen@xiaming.me'
@@ -38,6 +38,8 @@ def top_compare():
 
         mobgraphs[nn][person.id] = person.convert2graph()
 
+    # (topmesos, topmotif) pairs, stored as one binary batch at the end
+    topgraphs = []
     new_file = True
     for C in range(2, 16):
         for kn in range(1, 5):
@@ -100,10 +102,13 @@ def top_compare():
 
             ofile.write('%d\t%d' % (C, kn))
             ofile.write('\t%.3f\t%.3f' % (topmesos_sim, topmotif_supp))
-            ofile.write('\t%s' % dumps_mobgraph(topmesos))
-            ofile.write('\t%s' % dumps_mobgraph(topmotif))
             ofile.write('\n')
             ofile.close()
+            topgraphs.extend([topmesos, topmotif])
+
+    ofile = open(ofname + '.bin', 'wb')
+    ofile.write(dumpb_mobgraphs(topgraphs, norm=True))
+    ofile.close()
 
 
 def trv_distance():
@@ -191,25 +196,34 @@ def draw_top_compare():
 
     ifname = 'data/mesos0825_s0dot2/mesos0825_s0dot2_stat'
 
+    topgraphs = loadb_mobgraphs(open(ifname + '.bin', 'rb').read())
+
     res = []
     for line in open(ifname):
-        group, kn, mesos_sim, motif_supp, mesos, motif = line.strip('\r\n').split('\t')
+        group, kn, mesos_sim, motif_supp = line.strip('\r\n').split('\t')
 
-        mesos = loads_mobgraph(mesos)
-        motif = loads_mobgraph(motif)
+        mesos = topgraphs[2 * len(res)]
+        motif = topgraphs[2 * len(res) + 1]
         res.append((int(group), int(kn), float(mesos_sim), float(motif_supp), mesos, motif))
 
     ncol = 5
     nrow = np.ceil(1.0 * len(res) / ncol)
 
+    layouts = MotifLayouts()
     plt.figure(figsize=(20, 40))
     for i in range(len(res)):
         motif = res[i][5]
         supp = res[i][3]
+        key = canonical_form(motif)
         plt.subplot(nrow, ncol, i+1)
-        draw_networkx(motif)
+        ax = plt.gca()
+        draw_network(motif_graph(key), layouts.get(key), ax)
+        ax.autoscale()
+        plt.axis('equal')
+        plt.axis('off')
         plt.title('%.1f%%, nn=%d' % (supp * 100, motif.number_of_nodes()))
 
+    layouts.save()
     plt.savefig('figures/mesos0825_s0.2_top_motif.pdf')
 
 
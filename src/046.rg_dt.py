@@ -2,12 +2,17 @@
 # -*- encoding: utf-8 -*-
 # Extract and analyze the mobility Mesos using Apache Spark.
 import sys, os
+import argparse
+import cPickle
+import heapq
+import itertools
+import tempfile
 
 import numpy as np
 
 from xoxo.bsmap import BaseStationMap
 from xoxo.permov import movement_reader
-from xoxo.utils import radius_of_gyration
+from xoxo.utils import RgAccumulator
 
 __author__ = 'Xiaming Chen'
 __email__ = 'chen@xiaming.me'
@@ -17,199 +22,327 @@ def format_time(ts):
     return ts.strftime("%m%d")
 
 
-def daily_rg(movdata, bsmap, output):
+class DailyRg(object):
     """ R_g for one day
     """
-    bsmap = BaseStationMap(bsmap)
+    name = 'daily_rg'
 
-    res = {}
-    for person in movement_reader(open(movdata, 'rb'), bsmap):
+    def __init__(self, output):
+        self.output = output
+        self.res = {}
+
+    def consume(self, person):
         uid = person.id
         tdate = person.dtstart.strftime("%m%d")
         rg = person.radius_of_gyration()
-        if tdate not in res:
-            res[tdate] = []
-        res[tdate].append((uid, rg))
-
-    for tdate in res:
-        try:
-            os.mkdir(output)
-        except:
-            pass
-        ofile = open(os.path.join(output, tdate), 'wb')
-        [ofile.write('%d,%.4f\n' % (i[0],i[1])) for i in sorted(res[tdate], key=lambda x: x[0])]
-        ofile.close()
-
-
-def accu_rg(movdata, bsmap, output):
+        if tdate not in self.res:
+            self.res[tdate] = []
+        self.res[tdate].append((uid, rg))
+
+    def close(self):
+        res = self.res
+        for tdate in res:
+            try:
+                os.mkdir(self.output)
+            except:
+                pass
+            ofile = open(os.path.join(self.output, tdate), 'wb')
+            [ofile.write('%d,%.4f\n' % (i[0],i[1])) for i in sorted(res[tdate], key=lambda x: x[0])]
+            ofile.close()
+
+
+class AccuRg(object):
     """ Accumulative R_g over multiple days
     """
-    bsmap = BaseStationMap(bsmap)
-
+    name = 'accu_rg'
     dates = {'0820': 0, '0821': 1, '0822': 2, '0823': 3, '0824': 4, '0825': 5, '0826': 6}
 
-    res = {}
-    coords = {}
-    for person in movement_reader(open(movdata, 'rb'), bsmap):
+    def __init__(self, output):
+        self.output = output
+        self.res = {}
+        self.rgs = {}
+
+    def consume(self, person):
         uid = person.id
         tdate = person.which_day()
-        if tdate not in dates:
-            continue
+        if tdate not in self.dates:
+            return
 
-        if uid not in coords:
-            coords[uid] = person.coordinates
-        else:
-            coords[uid].extend(person.coordinates)
+        if uid not in self.rgs:
+            self.rgs[uid] = RgAccumulator()
+        self.rgs[uid].add(person.coordinates)
 
+        res = self.res
         if uid not in res:
             res[uid] = np.empty(7)
             res[uid].fill(-1)
 
-        res[uid][dates[tdate]] = radius_of_gyration(coords[uid])
-
-    res2 = []
-    for uid in res:
-        v = res[uid]
-        v2 = []
-        for n in v:
-            if n == -1:
-                try:
-                    v2.append(v2[-1])
-                except:
-                    v2.append(0)
-            else:
-                v2.append(n)
-        res2.append((uid, v2))
-    res2 = sorted(res2, key=lambda x: x[0])
-
-    ofile = open(output, 'wb')
-    [ofile.write('%d,%s\n' % (i[0], ','.join(['%.4f' % j for j in i[1]]))) for i in res2]
-    ofile.close()
-
-
-def accu_dt(movdata, bsmap, output, log=True):
-    """ Distribution of dwelling time for each person
-    """
-    bsmap = BaseStationMap(bsmap)
-
-    res = {}
-    for person in movement_reader(open(movdata, 'rb'), bsmap):
-        uid = person.id
-        dt = person.accdwelling.values()
-        if uid not in res:
-            res[uid] = dt
-        else:
-            res[uid].extend(dt)
+        res[uid][self.dates[tdate]] = self.rgs[uid].value()
+
+    def close(self):
+        res = self.res
+        res2 = []
+        for uid in res:
+            v = res[uid]
+            v2 = []
+            for n in v:
+                if n == -1:
+                    try:
+                        v2.append(v2[-1])
+                    except:
+                        v2.append(0)
+                else:
+                    v2.append(n)
+            res2.append((uid, v2))
+        res2 = sorted(res2, key=lambda x: x[0])
+
+        ofile = open(self.output, 'wb')
+        [ofile.write('%d,%s\n' % (i[0], ','.join(['%.4f' % j for j in i[1]]))) for i in res2]
+        ofile.close()
 
-    ofile = open(output, 'wb')
-    if log is True:
-        bins = np.logspace(-2,2,50)
-    else:
-        bins = np.arange(0,24.5,0.5)
 
+def _dt_bins(ofile, log):
     if log is True:
         ofile.write('#bins np.logspace(-2,2,50)\n')
+        return np.logspace(-2,2,50)
     else:
         ofile.write('#bins np.arange(0,24.5,0.5)\n')
+        return np.arange(0,24.5,0.5)
 
-    for uid in res:
-        hist = np.histogram(np.array(res[uid])/3600, bins=bins)[0]
-        ofile.write('%d,%s\n' % (uid, ','.join([str(h) for h in hist])))
-    ofile.close()
 
+class UserStore(object):
+    """ Per-user accumulator states with an out-of-core spill.
 
-def loc_dt(movdata, bsmap, output, log=True):
-    """ Distribution of dwelling time for each person, each location
+    States live in a dict until more than `max_users` users are held; the
+    dict is then written to a temporary file as a run sorted by uid and
+    cleared. :meth:`items` merges the runs with what is left in memory and
+    yields `(uid, state)` in uid order, combining the partial states of
+    a user with `merge(a, b)`.
     """
-    bsmap = BaseStationMap(bsmap)
 
-    res = {}
-    for person in movement_reader(open(movdata, 'rb'), bsmap):
-        uid = person.id
-        dt = person.accdwelling
-        if uid not in res:
-            res[uid] = {}
-        for k, v in dt.items():
-            if k not in res[uid]:
-                res[uid][k] = []
-            res[uid][k].append(v)
+    def __init__(self, new, merge, max_users=None):
+        self.new = new
+        self.merge = merge
+        self.max_users = max_users
+        self.res = {}
+        self.runs = []
+
+    def get(self, uid):
+        if uid not in self.res:
+            if self.max_users is not None and len(self.res) >= self.max_users:
+                self.spill()
+            self.res[uid] = self.new()
+        return self.res[uid]
+
+    def spill(self):
+        run = tempfile.TemporaryFile()
+        for item in sorted(self.res.items(), key=lambda x: x[0]):
+            cPickle.dump(item, run, cPickle.HIGHEST_PROTOCOL)
+        run.seek(0)
+        self.runs.append(run)
+        self.res = {}
+
+    @staticmethod
+    def _read_run(run, i):
+        while True:
+            try:
+                uid, state = cPickle.load(run)
+            except EOFError:
+                run.close()
+                return
+            yield uid, i, state
+
+    def items(self):
+        runs = [self._read_run(run, i) for i, run in enumerate(self.runs)]
+        runs.append((uid, len(runs), state) for uid, state in
+                    sorted(self.res.items(), key=lambda x: x[0]))
+        self.runs = []
+        self.res = {}
+        # The run index breaks uid ties so that states are never compared.
+        merged = heapq.merge(*runs)
+        for uid, group in itertools.groupby(merged, key=lambda x: x[0]):
+            state = None
+            for _, _, part in group:
+                state = part if state is None else self.merge(state, part)
+            yield uid, state
+
+
+class AccuDt(object):
+    """ Distribution of dwelling time for each person
+    """
+    name = 'accu_dt'
+
+    def __init__(self, output, log=True, max_users=None):
+        self.output = output
+        self.log = log
+        self.bins = np.logspace(-2,2,50) if log else np.arange(0,24.5,0.5)
+        self.res = UserStore(lambda: np.zeros(len(self.bins) - 1, np.int64),
+                             lambda a, b: a + b, max_users)
+
+    def consume(self, person):
+        hist = self.res.get(person.id)
+        dt = np.array(person.accdwelling.values())
+        hist += np.histogram(dt/3600, bins=self.bins)[0]
+
+    def close(self):
+        ofile = open(self.output, 'wb')
+        _dt_bins(ofile, self.log)
+        for uid, hist in self.res.items():
+            ofile.write('%d,%s\n' % (uid, ','.join([str(h) for h in hist])))
+        ofile.close()
 
-    ofile = open(output, 'wb')
-    if log is True:
-        bins = np.logspace(-2,2,50)
-    else:
-        bins = np.arange(0,24.5,0.5)
 
-    if log is True:
-        ofile.write('#bins np.logspace(-2,2,50)\n')
-    else:
-        ofile.write('#bins np.arange(0,24.5,0.5)\n')
+def _merge_locs(a, b):
+    for k, v in b.items():
+        if k in a:
+            a[k][0] += v[0]
+            a[k][1] += v[1]
+        else:
+            a[k] = v
+    return a
 
-    for uid in res:
-        vs = [np.average(v) for k, v in res[uid].items()]
-        hist = np.histogram(np.array(vs)/3600, bins=bins)[0]
-        ofile.write('%d,%s\n' % (uid, ','.join([str(h) for h in hist])))
-    ofile.close()
 
+class LocDt(object):
+    """ Distribution of dwelling time for each person, each location
+    """
+    name = 'loc_dt'
+
+    def __init__(self, output, log=True, max_users=None):
+        self.output = output
+        self.log = log
+        self.res = UserStore(dict, _merge_locs, max_users)
+
+    def consume(self, person):
+        locs = self.res.get(person.id)
+        for k, v in person.accdwelling.items():
+            if k not in locs:
+                locs[k] = [0, 0]
+            locs[k][0] += v
+            locs[k][1] += 1
+
+    def mean_dwelling(self):
+        """ Mean dwelling time in hours of each location, per person.
+        """
+        for uid, locs in self.res.items():
+            yield uid, [float(s) / n / 3600 for s, n in locs.values()]
+
+    def close(self):
+        ofile = open(self.output, 'wb')
+        bins = _dt_bins(ofile, self.log)
+        for uid, vs in self.mean_dwelling():
+            hist = np.histogram(vs, bins=bins)[0]
+            ofile.write('%d,%s\n' % (uid, ','.join([str(h) for h in hist])))
+        ofile.close()
 
-def loc_dt_all(movdata, bsmap, output):
+
+class LocDtAll(LocDt):
     """ All raw dwelling times for each person, each location
     """
-    bsmap = BaseStationMap(bsmap)
+    name = 'loc_dt_all'
 
-    res = {}
-    for person in movement_reader(open(movdata, 'rb'), bsmap):
-        uid = person.id
-        dt = person.accdwelling
-        if uid not in res:
-            res[uid] = {}
-        for k, v in dt.items():
-            if k not in res[uid]:
-                res[uid][k] = []
-            res[uid][k].append(v)
-
-    ofile = open(output, 'wb')
-    for uid in res:
-        vs = sorted([np.average(v)/3600 for k, v in res[uid].items()], reverse=True)
-        ofile.write('%d,%s\n' % (uid, ','.join(['%.3f' % v for v in vs])))
-    ofile.close()
+    def close(self):
+        ofile = open(self.output, 'wb')
+        for uid, vs in self.mean_dwelling():
+            vs = sorted(vs, reverse=True)
+            ofile.write('%d,%s\n' % (uid, ','.join(['%.3f' % v for v in vs])))
+        ofile.close()
 
 
-def mobgraph_degree(movdata, bsmap, output):
+class MobgraphDegree(object):
     """ Node degree of mobility graphs
     """
-    nloc = []
-    ndgr = []
-    bsmap = BaseStationMap(bsmap)
+    name = 'mobgraph_degree'
 
-    for person in movement_reader(open(movdata, 'rb'), bsmap):
+    def __init__(self, output):
+        self.output = output
+        self.nloc = []
+        self.ndgr = []
+
+    def consume(self, person):
         if person.distinct_loc_num() < 2:
-            continue
+            return
+
+        graph = person.convert2mobgraph()
+        self.ndgr.append(np.mean(graph.degree()))
+        self.nloc.append(person.distinct_loc_num())
+
+    def close(self):
+        ofile = open(self.output, 'wb')
+        ofile.write('nloc,ndgr\n')
+        ofile.write('\n'.join( ['%d,%.3f' % (x,y) for x, y in zip(self.nloc, self.ndgr)]))
+        ofile.close()
+
+
+SINKS = [DailyRg, AccuRg, AccuDt, LocDt, LocDtAll, MobgraphDegree]
 
-        graph = person.convert2graph()
-        ndgr.append(np.mean(graph.degree().values()))
-        nloc.append(person.distinct_loc_num())
 
-    ofile = open(output, 'wb')
-    ofile.write('nloc,ndgr\n')
-    ofile.write('\n'.join( ['%d,%.3f' % (x,y) for x, y in zip(nloc, ndgr)]))
+def run_sinks(movdata, bsmap, sinks):
+    """ Feed every person-day of the movement data to all sinks in a
+    single pass, then let each sink write its output.
+    """
+    bsmap = BaseStationMap(bsmap)
+    for person in movement_reader(open(movdata, 'rb'), bsmap):
+        for sink in sinks:
+            sink.consume(person)
+    for sink in sinks:
+        sink.close()
+
+
+def daily_rg(movdata, bsmap, output):
+    run_sinks(movdata, bsmap, [DailyRg(output)])
+
+
+def accu_rg(movdata, bsmap, output):
+    run_sinks(movdata, bsmap, [AccuRg(output)])
+
+
+def accu_dt(movdata, bsmap, output, log=True, max_users=None):
+    run_sinks(movdata, bsmap, [AccuDt(output, log, max_users)])
+
+
+def loc_dt(movdata, bsmap, output, log=True, max_users=None):
+    run_sinks(movdata, bsmap, [LocDt(output, log, max_users)])
+
+
+def loc_dt_all(movdata, bsmap, output, max_users=None):
+    run_sinks(movdata, bsmap, [LocDtAll(output, max_users=max_users)])
+
+
+def mobgraph_degree(movdata, bsmap, output):
+    run_sinks(movdata, bsmap, [MobgraphDegree(output)])
 
 
 def main():
-    if len(sys.argv) < 4:
-        print >> sys.stderr, "Usage: mesos <movdata> <bsmap> <output>"
-        exit(-1)
-
-    movdata = sys.argv[1]
-    bsmap = sys.argv[2]
-    output = sys.argv[3]
-
-    # daily_rg(movdata, bsmap, output)
-    # accu_rg(movdata, bsmap, output)
-    # accu_dt(movdata, bsmap, output)
-    # loc_dt(movdata, bsmap, output)
-    # loc_dw_all(movdata, bsmap, output)
-    mobgraph_degree(movdata, bsmap, output)
+    parser = argparse.ArgumentParser(
+        description='R_g, dwelling time and degree statistics in one pass over movement data. '
+                    'Each selected metric is written to <output>/<metric>; all metrics are '
+                    'computed when none is selected.')
+    parser.add_argument('movdata')
+    parser.add_argument('bsmap')
+    parser.add_argument('output')
+    for sink in SINKS:
+        parser.add_argument('--' + sink.name.replace('_', '-'), dest=sink.name,
+                            action='store_true', help=sink.__doc__.strip())
+    parser.add_argument('--linear-bins', action='store_true',
+                        help='Linear instead of log bins for dwelling time histograms')
+    parser.add_argument('--max-users', type=int, default=None,
+                        help='Users held in memory by dwelling time metrics before spilling to disk')
+    args = parser.parse_args()
+
+    selected = [sink for sink in SINKS if getattr(args, sink.name)] or SINKS
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+
+    sinks = []
+    for sink in selected:
+        output = os.path.join(args.output, sink.name)
+        if sink in (AccuDt, LocDt):
+            sinks.append(sink(output, log=not args.linear_bins, max_users=args.max_users))
+        elif sink is LocDtAll:
+            sinks.append(sink(output, max_users=args.max_users))
+        else:
+            sinks.append(sink(output))
+    run_sinks(args.movdata, args.bsmap, sinks)
 
 
 if __name__ == '__main__':
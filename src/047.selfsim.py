@@ -6,7 +6,7 @@ import numpy as np
 
 from xoxo.bsmap import BaseStationMap
 from xoxo.permov import movement_reader
-from xoxo.utils import dumps_mobgraph
+from xoxo.utils import dumpb_mobgraphs
 
 __author__ = 'Xiaming Chen'
 __email__ = 'chen@xiaming.me'
@@ -37,18 +37,24 @@ def validate_selfsim():
 
     print len(users)
 
+    # Graphs go to a binary batch file, line i of `ofname` describes graph i
+    graphs = []
     ofile = open(ofname, 'wb')
     for person in movement_reader(open(movdata), BaseStationMap(bsmap)):
         if person.id not in users or person.distinct_loc_num() < 2:
             continue
 
         user = users[person.id]
-        ofile.write('%d\t%d\t%d\t%.3f\t%.3f\t%s\t%s\n' % (
-            person.id, user[0], user[1], user[2], user[3], user[4],
-            dumps_mobgraph(person.convert2graph())))
+        ofile.write('%d\t%d\t%d\t%.3f\t%.3f\t%s\t%d\n' % (
+            person.id, user[0], user[1], user[2], user[3], user[4], len(graphs)))
+        graphs.append(person.convert2graph())
 
     ofile.close()
 
+    ofile = open(ofname + '.bin', 'wb')
+    ofile.write(dumpb_mobgraphs(graphs, norm=True))
+    ofile.close()
+
 
 if __name__ == '__main__':
     validate_selfsim()
@@ -3,106 +3,81 @@
 import sys, os
 
 import numpy as np
-import networkx as nx
 
 from xoxo.bsmap import BaseStationMap
-from xoxo.utils import greate_circle_distance
+from xoxo.utils import hop_distances
 from xoxo.permov import movement_reader
+from xoxo.spatial import SpatialIndex
+from xoxo.oppmap import load_oppmap
 
 
 __author__ = 'Xiaming Chen'
 __email__ = 'chen@xiaming.me'
 
 
-def load_oppmap(bsmap):
-    """ Draw opportunity map from Flowmap
-    """
-    ifname = 'data/hcl_mesos0825_flowmap'
-
-
-    last_interval = None
-    graph = nx.Graph()
-    nw = {}
-
-    for line in open(ifname, 'rb'):
-        interval, src, dst, total, unique = line.strip('\r\n').split(',')
-        interval = int(interval)
-        src = bsmap.get_coordinates(int(src))
-        dst = bsmap.get_coordinates(int(dst))
-        total = int(total)
-        unique = int(unique)
+def opportunity_stats(opindex, lons, lats, hops, radius, delta=0.05):
+    """ Opportunities of a batch of steps, each going from (lon, lat) over
+    a hop distance, within `radius` of its origin.
 
-        # if last_interval and interval != last_interval:
-        #     break
-
-        if dst not in nw:
-            nw[dst] = unique
-        else:
-            nw[dst] += unique
-
-        graph.add_edge(src, dst)
+    Intervening opportunities are closer than the next location
+    (gcd < hop * (1 - delta)), available ones lie in the ring
+    hop * (1 -/+ delta). Returns totals and maxima of both.
+    """
+    inner = hops * (1 - delta)
+    outer = np.minimum(hops * (1 + delta), radius)
+    _, avops_total, avops_max = opindex.annulus_stats(lons, lats, inner, outer)
+    _, inops_total, inops_max = opindex.radius_stats(
+        lons, lats, np.minimum(np.nextafter(inner, -np.inf), radius))
+    return avops_total, inops_total, avops_max, inops_max
 
-        last_interval = interval
 
-    for nid in graph.nodes():
-        if nid in nw:
-            graph.node[nid]['weight'] = nw[nid]
-        else:
-            graph.node[nid]['weight'] = 0
+def _write_chunk(ofile, opindex, chunk, alpha, delta):
+    uids = np.concatenate([i[0] for i in chunk])
+    rgs = np.concatenate([i[1] for i in chunk])
+    origins = np.concatenate([i[2] for i in chunk])
+    hops = np.concatenate([i[3] for i in chunk])
+    steps = np.concatenate([np.arange(len(i[3])) for i in chunk])
 
-    return graph
+    stats = opportunity_stats(opindex, origins[:, 0], origins[:, 1], hops, rgs * alpha, delta)
+    for row in zip(uids, steps, rgs, hops, *stats):
+        ofile.write('%d,%d,%.4f,%.4f,%.0f,%.0f,%.0f,%.0f\n' % row)
 
 
-def opmap_stat():
-    movdata = 'data/hcl_mesos0825'
-    bsmap = 'data/hcl_mesos0825_bm'
+def opmap_stat(movdata, bsmap, flowmap, output, alpha=1, delta=0.05, chunk_size=1000):
+    """ Opportunity statistics of every step of every person, computed
+    for chunks of persons at a time and streamed to `output`.
+    """
     bsmap = BaseStationMap(bsmap)
 
-    opgraph = load_oppmap(bsmap)
-    opnodes = opgraph.nodes(data=True)
+    opnodes, opweights, _ = load_oppmap(flowmap, bsmap)
+    opindex = SpatialIndex(opnodes, opweights)
 
+    ofile = open(output, 'wb')
+    ofile.write('uid,step,rg,dist,avops_total,inops_total,avops_max,inops_max\n')
+
+    chunk = []
     for person in movement_reader(open(movdata, 'rb'), bsmap):
         if person.distinct_loc_num() < 2:
             continue
 
         rg = person.radius_of_gyration()
-        alpha = 1
-        delta = 0.05
-        locs = person.coordinates
-        home = person.coordinates[0]
-        max_trd = np.max([greate_circle_distance(home[0], home[1], i[0], i[1]) for i in person.coordinates])
-
-        for i in range(0, len(locs) - 1):
-            j = i + 1
-            dist = greate_circle_distance(locs[i][0], locs[i][1], locs[j][0], locs[j][1])
-
-            # all opportunities for current location with radius rg
-            person_opnodes = []
-            for nn, vv in opnodes:
-                if greate_circle_distance(nn[0], nn[1], locs[i][0], locs[i][1]) <= rg * alpha:
-                    person_opnodes.append((nn, vv['weight']))
-
-            aops = []
-            iops = []
+        coords = np.array(person.coordinates)
+        nstep = len(coords) - 1
+        chunk.append((np.repeat(person.id, nstep), np.repeat(rg, nstep),
+                      coords[:-1], hop_distances(coords)))
 
-            for nn, value in person_opnodes:
-                gcd = greate_circle_distance(locs[i][0], locs[i][1], nn[0], nn[1])
-                if gcd < dist * (1 - delta):
-                    iops.append((nn, value))
-                elif gcd >= dist * (1 - delta) and gcd <= dist * (1 + delta):
-                    aops.append((nn, value))
+        if len(chunk) >= chunk_size:
+            _write_chunk(ofile, opindex, chunk, alpha, delta)
+            chunk = []
 
-            print aops, iops
-
-            avops_total = np.sum([p[1] for p in aops])
-            avops_max = np.max([p[1] for p in aops])
-            inops_total = np.sum([p[1] for p in iops])
-            inops_max = np.max([p[1] for p in iops])
-
-            print person.id, rg, avops_total, inops_total, avops_max, inops_max
-
-        break
+    if len(chunk) > 0:
+        _write_chunk(ofile, opindex, chunk, alpha, delta)
+    ofile.close()
 
 
 if __name__ == '__main__':
-    print opmap_stat()
\ No newline at end of file
+    if len(sys.argv) < 5:
+        print("Usage: %s <movdata> <bsmap> <flowmap> <output>" % sys.argv[0])
+        sys.exit(-1)
+
+    opmap_stat(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4])
@@ -1,61 +1,23 @@
 #!/usr/bin/env python
 # -*- encoding: utf-8 -*-
 import sys, os
+import argparse
+from multiprocessing import Pool, cpu_count
 
 import numpy as np
-import networkx as nx
-from scipy.stats import rv_continuous, lognorm
+from scipy.special import ndtr, ndtri
 
 from xoxo.permov import movement_reader
 from xoxo.bsmap import BaseStationMap
-from xoxo.utils import greate_circle_distance, radius_of_gyration
+from xoxo.utils import hop_distances, radius_of_gyration_batch, travel_distance_batch
+from xoxo.oppmap import load_oppmap, distance_table
+from xoxo.simulation import RandomPolicy, MaxDistancePolicy, Simulator, simulate, save_features
 
 
 __author__ = 'Xiaming Chen'
 __email__ = 'chen@xiaming.me'
 
 
-def load_oppmap(bsmap):
-    """ Draw opportunity map from Flowmap
-    """
-    ifname = 'data/hcl_mesos0825_flowmap'
-
-    last_interval = None
-    graph = nx.Graph()
-    nw = {}
-
-    for line in open(ifname, 'rb'):
-        interval, src, dst, total, unique = line.strip('\r\n').split(',')
-        interval = int(interval)
-        src = bsmap.get_coordinates(int(src))
-        dst = bsmap.get_coordinates(int(dst))
-        total = int(total)
-        unique = int(unique)
-
-        # if last_interval and interval != last_interval:
-        #     break
-
-        if dst not in nw:
-            nw[dst] = unique
-        else:
-            nw[dst] += unique
-
-        if unique > 20:
-            graph.add_edge(src, dst)
-
-        last_interval = interval
-
-    for nid in graph.nodes():
-        if nid in nw:
-            graph.node[nid]['weight'] = nw[nid]
-        else:
-            graph.node[nid]['weight'] = 0
-
-    print len(graph.nodes())
-
-    return graph
-
-
 def load_dtmodels():
     """ Read dwelling time models
     """
@@ -74,222 +36,196 @@ def load_dtmodels():
     return models
 
 
-class DtGenerator(rv_continuous):
-    """ Generate two-mode lognormal dist for dwelling time
+def _truncated_lognorm(mu, sigma, a, b, u):
+    """ Inverse CDF of a lognormal truncated to [a, b] at quantiles u
     """
-    def _pdf(self, x, mu1, mu2, sigma1, sigma2, lamb):
-        return lamb * lognorm.pdf(x, s=sigma1, scale=np.exp(mu1)) +\
-               (1 - lamb) * lognorm.pdf(x, s=sigma2, scale=np.exp(mu2))
-
-
-def random_dt(mu1, mu2, sigma1, sigma2, lamb):
-    dg = DtGenerator(name='dtdist', a=0.1, b=8)
-    dt = dg.rvs(mu1, mu2, sigma1, sigma2, lamb)
-    return dt
+    lo = ndtr((np.log(a) - mu) / sigma)
+    hi = ndtr((np.log(b) - mu) / sigma)
+    return np.exp(mu + sigma * ndtri(lo + u * (hi - lo)))
 
 
-class RgGenerator(rv_continuous):
+def random_dt(mu1, mu2, sigma1, sigma2, lamb, size=None, random_state=np.random, a=0.1, b=8):
+    """ Draw dwelling times from a two-mode lognormal mixture truncated
+    to [a, b]: pick a mode by its mass inside the bounds, then invert the
+    truncated lognormal CDF of that mode.
+    """
+    m1 = lamb * (ndtr((np.log(b) - mu1) / sigma1) - ndtr((np.log(a) - mu1) / sigma1))
+    m2 = (1 - lamb) * (ndtr((np.log(b) - mu2) / sigma2) - ndtr((np.log(a) - mu2) / sigma2))
+    n = 1 if size is None else size
+    first = random_state.random_sample(n) < m1 / (m1 + m2)
+    u = random_state.random_sample(n)
+    dt = np.where(first,
+                  _truncated_lognorm(mu1, sigma1, a, b, u),
+                  _truncated_lognorm(mu2, sigma2, a, b, u))
+    dt = np.clip(dt, a, b)
+    return dt[0] if size is None else dt
+
+
+class RgGenerator(object):
     """ Generate random R_g according to empirical distribution. Ref. mesos paper
     """
+    def __init__(self, a=0.5, b=10, npoints=4096):
+        self.x = np.linspace(a, b, npoints)
+        pdf = self._pdf(self.x)
+        cdf = np.concatenate([[0], np.cumsum((pdf[1:] + pdf[:-1]) / 2 * np.diff(self.x))])
+        self.cdf = cdf / cdf[-1]
+
     def _pdf(self, x):
         return np.exp(-2.36 + 0.601 * x - 0.141 * np.power(x, 2)) * np.power(x, 0.22)
 
-gen_rg = RgGenerator(name='rgdist', a = 0.5, b = 10)
+    def rvs(self, size=None, random_state=np.random):
+        """ Samples by linear interpolation of the inverse CDF table
+        """
+        u = random_state.random_sample(1 if size is None else size)
+        rg = np.interp(u, self.cdf, self.x)
+        return rg[0] if size is None else rg
 
+gen_rg = RgGenerator(a = 0.5, b = 10)
 
-def person_map(curlocs, rg, global_opmap):
-    """ Generate individual's map
-    """
-    assert isinstance(curlocs, list)
 
-    iops = []
-    for node in global_opmap.nodes():
-        s = [node]
-        s.extend(curlocs)
-        if radius_of_gyration(s) <= rg:
-            iops.append(node)
-
-    return iops
-
-
-def gen_random_home(opmap):
-    """ Select random location from opportunity map
+class AgentProfile(object):
+    """ Random home, R_g and a day of dwelling times for one agent
     """
-    locs = [i[0] for i in opmap.nodes(data=True)]
-    return locs[np.random.random_integers(len(locs))]
-
-
-def model_random():
-    ofname = 'data/mesos_model_rwm_stat'
-    ofile = open(ofname, 'wb')
+    def __init__(self, dtmodels, timebound=18):
+        self.dtmodels = dtmodels
+        self.maxsteps = int(timebound / 0.1) + 1     # dwelling times are at least 0.1
 
-    bsmap = BaseStationMap('data/hcl_mesos0825_bm')
-    opmap = load_oppmap(bsmap)
-    dtmodel = load_dtmodels()
-    nmodel = len(dtmodel)
-
-    TIMEBOUND = 18
-
-    for j in range(1, 1000):
-        # User profile
-        uid = j
-        dtm = dtmodel[np.random.random_integers(nmodel)]
-        rhome = gen_random_home(opmap)
-
-        rg = gen_rg.rvs()
-        print '%d: %.3f' % (uid, rg)
-
-        traj = [rhome]
-        traj_dts = [6]
-        acctime = 0
-        isvalid = True
-        while acctime < TIMEBOUND:
-            print acctime
-
-            # determine dwelling time
-            dt = random_dt(dtm[0], dtm[1], dtm[2], dtm[3], dtm[4])
-            if acctime + dt > TIMEBOUND:
-                dt = TIMEBOUND - acctime
-
-            traj_dts.append(dt)
-            acctime += dt
-
-            # determine location
-            try:
-                iops = person_map(traj, rg, opmap)
-                nextloc = iops[np.random.random_integers(len(iops))]
-                traj.append(nextloc)
-            except:
-                isvalid = False
-
-        if not isvalid:
-            print isvalid
-            continue
-
-        traj.append(rhome)
-        traj_dts.append(0)
-
-        # stat
-        totloc = len(set(traj))
-        dtloc = {}
-        for l in range(len(traj)):
-            if traj[l] not in dtloc:
-                dtloc[traj[l]] = 0
-            dtloc[traj[l]] += traj_dts[l]
-        trvdist = [greate_circle_distance(traj[i][0], traj[i][1], traj[i+1][0], traj[i+1][1]) for i in range(len(traj)-1)]
-        totdist = np.sum(trvdist)
-
-        print trvdist
-
-        ofile.write('%d\t%.3f\t%d\t%.3f\t%s\n' % (
-            uid, rg, totloc, totdist,
-            ','.join(['%.3f' % i for i in trvdist]),
-            ))
-
-    ofile.close()
+    def __call__(self, rng, nnodes):
+        dtm = self.dtmodels[rng.randint(len(self.dtmodels))]
+        home = rng.randint(nnodes)
+        rg = gen_rg.rvs(random_state=rng)
+        dts = random_dt(dtm[0], dtm[1], dtm[2], dtm[3], dtm[4], size=self.maxsteps, random_state=rng)
+        return home, rg, dts
 
 
-def model_maxoppo():
-    ofname = 'data/mesos_model_mom_stat'
-    ofile = open(ofname, 'wb')
-
+def load_opnodes():
     bsmap = BaseStationMap('data/hcl_mesos0825_bm')
-    opmap = load_oppmap(bsmap)
-    dtmodel = load_dtmodels()
-    nmodel = len(dtmodel)
-
-    TIMEBOUND = 18
-
-    for j in range(1, 1000):
-        # User profile
-        uid = j
-        dtm = dtmodel[np.random.random_integers(nmodel)]
-        rhome = gen_random_home(opmap)
-
-        rg = gen_rg.rvs()
-        print '%d: %.3f' % (uid, rg)
-
-        traj = [rhome]
-        traj_dts = [6]
-        acctime = 0
-        isvalid = True
-        while acctime < TIMEBOUND:
-            print acctime
-
-            # determine dwelling time
-            dt = random_dt(dtm[0], dtm[1], dtm[2], dtm[3], dtm[4])
-            if acctime + dt > TIMEBOUND:
-                dt = TIMEBOUND - acctime
-
-            traj_dts.append(dt)
-            acctime += dt
-
-            # determine location
-            try:
-                iops = person_map(traj, rg, opmap)
-                maxloc = rhome
-                maxdist = 0
-                for i in iops:
-                    if i != traj[-1]:
-                        dist = greate_circle_distance(i[0], i[1], traj[-1][0], traj[-1][1])
-                        if dist > maxdist:
-                            maxloc = i
-                            maxdist = dist
-                traj.append(maxloc)
-            except:
-                isvalid = False
-
-        if not isvalid:
-            print isvalid
-            continue
+    nodes, _, _ = load_oppmap('data/hcl_mesos0825_flowmap', bsmap, threshold=20)
+    return nodes
 
-        traj.append(rhome)
-        traj_dts.append(0)
 
-        # stat
-        totloc = len(set(traj))
-        dtloc = {}
-        for l in range(len(traj)):
-            if traj[l] not in dtloc:
-                dtloc[traj[l]] = 0
-            dtloc[traj[l]] += traj_dts[l]
-        trvdist = [greate_circle_distance(traj[i][0], traj[i][1], traj[i+1][0], traj[i+1][1]) for i in range(len(traj)-1)]
-        totdist = np.sum(trvdist)
+def run_model(nodes, policy, ofname, nagents=1000, seed=0, nproc=None):
+    simulator = Simulator([tuple(i) for i in nodes.tolist()], policy,
+                          AgentProfile(load_dtmodels()), timebound=18, seed=seed)
+    simulate(simulator, range(1, nagents + 1), ofname, nproc)
 
-        print trvdist
 
-        ofile.write('%d\t%.3f\t%d\t%.3f\t%s\n' % (
-            uid, rg, totloc, totdist,
-            ','.join(['%.3f' % i for i in trvdist]),
-        ))
-
-    ofile.close()
+def model_random(nagents=1000, seed=0, nproc=None):
+    run_model(load_opnodes(), RandomPolicy(), 'data/mesos_model_rwm_stat', nagents, seed, nproc)
 
 
-def empirical_data():
-    ifname = 'data/hcl_mesos0822_sample0.2'
-    bsmap = bsmap = BaseStationMap('data/hcl_mesos0822_bm')
-    ofile = open('data/mesos_model_emp_stat2', 'wb')
-
-    for person in movement_reader(open(ifname), bsmap):
+def model_maxoppo(nagents=1000, seed=0, nproc=None, table_radius=None, dense=False):
+    """ Node distances are read from a cached table instead of being
+    computed per step: a dense float32 node x node table memory mapped
+    from disk with `dense`, or only pairs within `table_radius` km.
+    """
+    if dense and table_radius is not None:
+        raise ValueError('choose either a dense table or a table radius')
+    nodes = load_opnodes()
+    table = None
+    if dense:
+        table = distance_table(nodes)
+    elif table_radius is not None:
+        table = distance_table(nodes, table_radius)
+    run_model(nodes, MaxDistancePolicy(table), 'data/mesos_model_mom_stat', nagents, seed, nproc)
+
+
+def _empirical_chunk(chunk):
+    coords = np.concatenate([i[2] for i in chunk])
+    counts = np.array([len(i[2]) for i in chunk])
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    seg = np.repeat(np.arange(len(chunk)), counts)
+    same = seg[:-1] == seg[1:]
+    return (np.array([i[0] for i in chunk]),
+            radius_of_gyration_batch(coords, offsets),
+            np.array([i[1] for i in chunk]),
+            travel_distance_batch(coords, offsets),
+            hop_distances(coords)[same],
+            offsets - np.arange(len(offsets)))
+
+
+def empirical_features(movdata, bsmap, chunk_size=10000):
+    """ Per-person R_g, number of distinct locations, travel distance and
+    hop distances of the movement data, in the column layout of
+    :func:`xoxo.simulation.save_features`. Statistics are computed for
+    chunks of persons at a time.
+    """
+    bsmap = BaseStationMap(bsmap)
+    parts = []
+    chunk = []
+    for person in movement_reader(open(movdata, 'rb'), bsmap):
         if len(person) < 2:
             continue
-
-        uid = person.id
-        rg = person.radius_of_gyration()
-        totloc = len(set(person.locations))
-        traj = person.coordinates
-        trvdist = [greate_circle_distance(traj[i][0], traj[i][1], traj[i+1][0], traj[i+1][1]) for i in range(len(traj)-1)]
-        totdist = np.sum(trvdist)
-
+        chunk.append((person.id, person.distinct_loc_num(), np.array(person.coordinates)))
+        if len(chunk) >= chunk_size:
+            parts.append(_empirical_chunk(chunk))
+            chunk = []
+    if len(chunk) > 0:
+        parts.append(_empirical_chunk(chunk))
+    if len(parts) == 0:
+        return [np.zeros(0)] * 5 + [np.zeros(1, np.int64)]
+
+    uid, rg, totloc, totdist, hops, offsets = zip(*parts)
+    ends = np.cumsum([0] + [i[-1] for i in offsets[:-1]])
+    offsets = np.concatenate([[0]] + [o[1:] + e for o, e in zip(offsets, ends)])
+    return [np.concatenate(i) for i in (uid, rg, totloc, totdist, hops)] + [offsets]
+
+
+def _empirical_day(args):
+    movdata, bsmap, output, text = args
+    uid, rg, totloc, totdist, hops, offsets = empirical_features(movdata, bsmap)
+    if not text:
+        save_features(output, uid, rg, totloc, totdist, hops, offsets)
+        return
+    ofile = open(output, 'wb', 1 << 20)
+    for i in range(len(uid)):
+        trvdist = hops[offsets[i]:offsets[i+1]]
         ofile.write('%d\t%.3f\t%d\t%.3f\t%s\n' % (
-            uid, rg, totloc, totdist,
-            ','.join(['%.3f' % i for i in trvdist]),
+            uid[i], rg[i], totloc[i], totdist[i],
+            ','.join(['%.3f' % j for j in trvdist]),
         ))
-
     ofile.close()
 
 
+def empirical_data(days=None, text=False, nproc=None):
+    """ Extract empirical features of several (movdata, bsmap, output)
+    days in parallel; outputs are npz columns unless `text` is set.
+    """
+    if days is None:
+        days = [('data/hcl_mesos0822_sample0.2', 'data/hcl_mesos0822_bm', 'data/mesos_model_emp_stat2')]
+    tasks = [(movdata, bsmap, output, text) for movdata, bsmap, output in days]
+    if len(tasks) == 1 or nproc == 1:
+        map(_empirical_day, tasks)
+        return
+    pool = Pool(min(nproc or cpu_count(), len(tasks)))
+    try:
+        pool.map(_empirical_day, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
 
 if __name__ == '__main__':
-    empirical_data()
+    parser = argparse.ArgumentParser(description='Empirical trajectory features of movement data, '
+                                                 'or of a mobility model with --model')
+    parser.add_argument('--day', nargs=3, action='append', metavar=('MOVDATA', 'BSMAP', 'OUTPUT'),
+                        help='One day of movement data; may be repeated')
+    parser.add_argument('--text', action='store_true',
+                        help='Write tab separated rows like the model runs instead of npz columns')
+    parser.add_argument('--nproc', type=int, default=None)
+    parser.add_argument('--model', choices=['random', 'maxoppo'],
+                        help='Simulate a model instead of extracting empirical features')
+    parser.add_argument('--agents', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    table = parser.add_mutually_exclusive_group()
+    table.add_argument('--dense', action='store_true',
+                       help='maxoppo: read node distances from a dense memory mapped table')
+    table.add_argument('--table-radius', type=float, default=None, metavar='KM',
+                       help='maxoppo: read node distances within KM from a sparse table')
+    args = parser.parse_args()
+    if args.model == 'random':
+        model_random(args.agents, args.seed, args.nproc)
+    elif args.model == 'maxoppo':
+        model_maxoppo(args.agents, args.seed, args.nproc, args.table_radius, args.dense)
+    else:
+        empirical_data(args.day, args.text or args.day is None, args.nproc)
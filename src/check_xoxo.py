@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# Check the optimised parts of xoxo against reference implementations
+# on a movement file; prints one line per check and fails on mismatches.
+import sys
+import argparse
+
+import numpy as np
+import networkx as nx
+
+from xoxo.bsmap import BaseStationMap
+from xoxo.permov import movement_reader
+from xoxo.utils import seq2graph, dumpb_mobgraph, loadb_mobgraph, dumpb_mobgraphs, loadb_mobgraphs
+from xoxo.utils import RgAccumulator, radius_of_gyration, radius_of_gyration_batch, \
+    travel_distance, travel_distance_batch
+from xoxo.geo import greate_circle_distance, cdist, cumulative_distance, path_length, LocalProjection
+from xoxo.motif import Motif
+from xoxo.sketch import HyperLogLog
+from xoxo.simulation import PersonMap, RandomPolicy, MaxDistancePolicy, Simulator
+
+__author__ = 'Xiaming Chen'
+__email__ = 'chen@xiaming.me'
+
+
+def movement_persons(movdata, bsmap):
+    return list(movement_reader(open(movdata, 'rb'), BaseStationMap(bsmap)))
+
+
+def graph_items(G):
+    """ All node and edge attributes of a DiGraph; edges without a
+    frequency count once, as in MobGraph.
+    """
+    return (sorted((n, sorted(d.items())) for n, d in G.nodes(data=True)),
+            sorted((s, t, sorted(dict(d, frequency=d.get('frequency', 1)).items()))
+                   for s, t, d in G.edges(data=True)))
+
+
+def codec_roundtrip(movdata, bsmap, nrandom=500, seed=0):
+    """ Round trip of the binary mobility graph codec on the day graphs of
+    a movement file and on random integer-node graphs with missing weights
+    and frequencies.
+    """
+    graphs = [p.convert2graph() for p in movement_persons(movdata, bsmap)]
+    rs = np.random.RandomState(seed)
+    randoms = []
+    for i in range(nrandom):
+        G = nx.gnp_random_graph(rs.randint(1, 12), rs.uniform(0.1, 0.6),
+                                seed=rs.randint(1 << 30), directed=True)
+        for n in G.nodes():
+            if rs.rand() < 0.8:
+                G.node[n]['weight'] = rs.randint(1 << 20)
+        for s, t in G.edges():
+            if rs.rand() < 0.8:
+                G[s][t]['weight'] = rs.uniform(0, 100)
+            if rs.rand() < 0.5:
+                G[s][t]['frequency'] = rs.randint(1, 10)
+        randoms.append(G)
+
+    res = {}
+    for name, gs in (('day graphs', graphs), ('random graphs', randoms)):
+        single = sum(graph_items(G) != graph_items(loadb_mobgraph(dumpb_mobgraph(G)))
+                     for G in gs)
+        compact = sum(graph_items(G) != graph_items(
+                      loadb_mobgraph(dumpb_mobgraph(G), compact=True).to_networkx())
+                      for G in gs)
+        batch = loadb_mobgraphs(dumpb_mobgraphs(gs))
+        batch = len(batch) != len(gs) or \
+            sum(graph_items(a) != graph_items(b) for a, b in zip(gs, batch))
+        res[('codec', name, 'single')] = (len(gs), single)
+        res[('codec', name, 'compact')] = (len(gs), compact)
+        res[('codec', name, 'batch')] = (len(gs), int(batch))
+    return res
+
+
+def isomorphism_counts(graphs):
+    """ Motif counts by the former bucketing: graphs with equal numbers of
+    nodes and edges are scanned with `Motif.is_isomorphic`. Returns sorted
+    (nnode, nedge, count) of all classes.
+    """
+    buckets = {}
+    for g in graphs:
+        classes = buckets.setdefault((g.number_of_nodes(), g.number_of_edges()), [])
+        for c in classes:
+            if Motif().is_isomorphic(g, c[0]):
+                c[1] += 1
+                break
+        else:
+            classes.append([g, 1])
+    return sorted((k[0], k[1], c[1]) for k, classes in buckets.items() for c in classes)
+
+
+def canonical_counts(graphs):
+    motifrepo = Motif()
+    for g in graphs:
+        motifrepo.add_graph(g)
+    return sorted((key[1], key[2], count) for key, count in motifrepo.key_iter())
+
+
+def motif_agreement(movdata, bsmap, nrandom=2000, seed=0):
+    """ Motif counts by canonical form against isomorphism scans on the day
+    graphs of a movement file and on random directed and undirected graphs,
+    each also added under a random node relabelling. Cases are classes; a
+    set fails as a whole when the sorted class counts differ.
+    """
+    day = [seq2graph(p.locations) for p in movement_persons(movdata, bsmap)]
+
+    rs = np.random.RandomState(seed)
+    sets = {'day graphs': day}
+    for directed in (True, False):
+        graphs = []
+        for i in range(nrandom):
+            g = nx.gnp_random_graph(rs.randint(1, 8), rs.uniform(0.2, 0.6),
+                                    seed=rs.randint(1 << 30), directed=directed)
+            perm = rs.permutation(g.number_of_nodes())
+            graphs.extend([g, nx.relabel_nodes(g, dict(enumerate(perm)))])
+        sets['random %s graphs' % ('directed' if directed else 'undirected')] = graphs
+
+    res = {}
+    for name, graphs in sets.items():
+        expected = isomorphism_counts(graphs)
+        res[('motif', name)] = (len(expected), int(canonical_counts(graphs) != expected))
+    return res
+
+
+def rg_reference(coordinates):
+    # Former per-point implementation of radius_of_gyration
+    clon = np.average([coord[0] for coord in coordinates])
+    clat = np.average([coord[1] for coord in coordinates])
+    return np.average([greate_circle_distance(clon, clat, coord[0], coord[1]) for coord in coordinates])
+
+
+def rg_accumulator_agreement(movdata, bsmap, rtol=1e-9, atol=1e-9):
+    """ The running RgAccumulator value of each user after each day against
+    R_g recomputed over all coordinates seen so far, as `046.rg_dt.accu_rg`
+    used to do. `atol` (km) absorbs the rounding of centroids onto a single
+    location.
+    """
+    accus = {}
+    seen = {}
+    cases = failures = 0
+    for person in movement_persons(movdata, bsmap):
+        accu = accus.setdefault(person.id, RgAccumulator())
+        accu.add(person.coordinates)
+        coords = seen.setdefault(person.id, [])
+        coords.extend(person.coordinates)
+        cases += 1
+        failures += not np.isclose(accu.value(), rg_reference(coords), rtol=rtol, atol=atol)
+    return {('rgaccu', 'RgAccumulator'): (cases, failures)}
+
+
+def travel_reference(coordinates):
+    # Former per-hop implementation of travel_distance
+    total = 0
+    for i in range(0, len(coordinates)-1):
+        lon1, lat1 = coordinates[i]
+        lon2, lat2 = coordinates[i+1]
+        total += greate_circle_distance(lon1, lat1, lon2, lat2)
+    return total
+
+
+def vectorized_agreement(movdata, bsmap, rtol=1e-9, atol=1e-9):
+    """ Array versions of R_g and travel distance, per person and batched
+    over all persons, against the former per-point code on the day
+    trajectories of a movement file.
+    """
+    persons = movement_persons(movdata, bsmap)
+    coords = [p.coordinates for p in persons]
+    rg = np.array([rg_reference(c) for c in coords])
+    dist = np.array([travel_reference(c) for c in coords])
+    offsets = np.concatenate([[0], np.cumsum([len(c) for c in coords])])
+    allcoords = np.array([i for c in coords for i in c], dtype=np.float64)
+
+    def failures(values, expected):
+        return int(np.sum(~np.isclose(values, expected, rtol=rtol, atol=atol)))
+
+    n = len(persons)
+    return {
+        ('vectorized', 'radius_of_gyration'): (n, failures([radius_of_gyration(c) for c in coords], rg)),
+        ('vectorized', 'radius_of_gyration_batch'): (n, failures(radius_of_gyration_batch(allcoords, offsets), rg)),
+        ('vectorized', 'travel_distance'): (n, failures([travel_distance(c) for c in coords], dist)),
+        ('vectorized', 'travel_distance_batch'): (n, failures(travel_distance_batch(allcoords, offsets), dist)),
+        ('vectorized', 'PersonMoveDay'): (n, failures([p.radius_of_gyration() for p in persons], rg) +
+                             failures([p.travel_dist() for p in persons], dist)),
+    }
+
+
+def sketch_accuracy(movdata, bsmap, precisions=(8, 10, 12, 14)):
+    """ HyperLogLog estimates of distinct users, stations and (user,
+    station) pairs, merged from 7 uneven chunks as partitions would be,
+    against exact counts. A case fails beyond three standard errors.
+    """
+    records = np.loadtxt(movdata, delimiter=',', usecols=(0, 2), dtype=np.int64, ndmin=2)
+    columns = [
+        ('users', records[:, 0]),
+        ('stations', records[:, 1]),
+        ('user-stations', (records[:, 0] << 32) | records[:, 1]),
+    ]
+    res = {}
+    for name, values in columns:
+        exact = len(np.unique(values))
+        failures = 0
+        for p in precisions:
+            parts = [HyperLogLog(p).update(i) for i in np.array_split(values, 7)]
+            hll = reduce(lambda a, b: a.merge(b), parts, HyperLogLog(p))
+            failures += abs(hll.count() - exact) > 3 * hll.error * exact
+        res[('sketch', name)] = (len(precisions), failures)
+    return res
+
+
+def atan2_reference(lon0, lat0, lon1, lat1, radius=6372.8):
+    # Former atan2 (Vincenty) form of greate_circle_distance
+    lat0, lon0, lat1, lon1 = [np.radians(i) for i in (lat0, lon0, lat1, lon1)]
+    dlon = lon0 - lon1
+    y = np.sqrt(
+        (np.cos(lat1) * np.sin(dlon)) ** 2
+        + (np.cos(lat0) * np.sin(lat1)
+           - np.sin(lat0) * np.cos(lat1) * np.cos(dlon)) ** 2)
+    x = np.sin(lat0) * np.sin(lat1) + \
+        np.cos(lat0) * np.cos(lat1) * np.cos(dlon)
+    return radius * np.arctan2(y, x)
+
+
+def geo_agreement(movdata, bsmap, n=100000, span=0.5, seed=0):
+    """ Distance kernels on random point pairs within `span` degrees of the
+    centre of the station map: the float64 kernel against the former atan2
+    form, float32 and local projections against the float64 kernel within
+    their documented error, and the path helpers against plain hop sums.
+    """
+    coords = np.array(BaseStationMap(bsmap).get_arrays()[1], dtype=np.float64)
+    lon0, lat0 = coords.mean(axis=0)
+    rs = np.random.RandomState(seed)
+    a = np.column_stack([lon0 + rs.uniform(-span, span, n), lat0 + rs.uniform(-span, span, n)])
+    b = np.column_stack([lon0 + rs.uniform(-span, span, n), lat0 + rs.uniform(-span, span, n)])
+    ref = greate_circle_distance(a[:, 0], a[:, 1], b[:, 0], b[:, 1])
+    far = ref > 0.1
+
+    def relerr(values, bound):
+        return int(np.sum(np.abs(values - ref)[far] / ref[far] > bound))
+
+    paths = [a[i:i + rs.randint(1, 20)] for i in range(0, 2000, 20)]
+    hopsums = np.array([sum(greate_circle_distance(p[j, 0], p[j, 1], p[j + 1, 0], p[j + 1, 1])
+                            for j in range(len(p) - 1)) for p in paths])
+    pathlen = np.array([path_length(p) for p in paths])
+    cumul = [cumulative_distance(p) for p in paths]
+    pairwise = cdist(a[:300], b[:200])
+    expected = greate_circle_distance(a[:300, 0:1], a[:300, 1:2], b[np.newaxis, :200, 0], b[np.newaxis, :200, 1])
+    return {
+        ('geo', 'atan2 form'): (n, relerr(atan2_reference(a[:, 0], a[:, 1], b[:, 0], b[:, 1]), 1e-9)),
+        ('geo', 'float32'): (n, relerr(greate_circle_distance(a[:, 0], a[:, 1], b[:, 0], b[:, 1],
+                                                              dtype=np.float32), 1e-6)),
+        ('geo', 'projection64'): (n, relerr(LocalProjection(lon0, lat0).distance(a, b), 1e-2)),
+        ('geo', 'projection32'): (n, relerr(LocalProjection(lon0, lat0, dtype=np.float32)
+                                            .distance(a, b), 1e-2)),
+        ('geo', 'cdist'): (pairwise.size, int(np.sum(pairwise != expected))),
+        ('geo', 'path_length'): (len(paths), int(np.sum(~np.isclose(pathlen, hopsums, rtol=1e-12)))),
+        ('geo', 'cumulative_distance'): (len(paths), sum(c[-1] != l for c, l in zip(cumul, pathlen))),
+    }
+
+
+def toy_profile(rng, nnodes):
+    return rng.randint(nnodes), rng.uniform(0.5, 5), rng.uniform(0.5, 4, rng.randint(1, 10))
+
+
+def simulation_agreement(movdata, bsmap, npersons=300, nagents=60, seed=0):
+    """ Batched candidate selection on observed trajectories (with R_g
+    bounds around their own R_g) against the exact test over all station
+    nodes, and agents run in one chunk against agents run one by one.
+    """
+    nodes = BaseStationMap(bsmap).get_arrays()[1]
+    pmap = PersonMap(nodes)
+    rs = np.random.RandomState(seed)
+    bylen = {}
+    for person in movement_persons(movdata, bsmap)[:npersons]:
+        locs = np.array(person.coordinates, dtype=np.float64)
+        rg = radius_of_gyration(person.coordinates) * rs.uniform(0.5, 2) + 0.1
+        bylen.setdefault(len(locs), []).append((locs, rg))
+    cases = failures = 0
+    for items in bylen.values():
+        owner, which = pmap.candidates_many([i[0] for i in items], [i[1] for i in items])
+        for i, (locs, rg) in enumerate(items):
+            expected = np.flatnonzero(pmap.rg_with(locs) <= rg)
+            cases += 1
+            failures += not np.array_equal(which[owner == i], expected)
+    res = {('simulation', 'candidates_many'): (cases, failures)}
+
+    uids = range(1, nagents + 1)
+    for policy in (RandomPolicy(), MaxDistancePolicy()):
+        simulator = Simulator(nodes, policy, toy_profile, seed=seed)
+        single = [simulator.run_agent(uid) for uid in uids]
+        failures = sum(repr(a) != repr(b) for a, b in zip(simulator.run_agents(uids), single))
+        res[('simulation', 'run_agents ' + type(policy).__name__)] = (nagents, failures)
+    return res
+
+
+CHECKS = [
+    ('codec', codec_roundtrip),
+    ('motif', motif_agreement),
+    ('rgaccu', rg_accumulator_agreement),
+    ('vectorized', vectorized_agreement),
+    ('sketch', sketch_accuracy),
+    ('geo', geo_agreement),
+    ('simulation', simulation_agreement),
+]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check xoxo against reference implementations')
+    parser.add_argument('checks', nargs='*',
+                        help='Checks to run among %s (default: all)' % ', '.join(i[0] for i in CHECKS))
+    parser.add_argument('--movdata', default='data/hcl.dat')
+    parser.add_argument('--bsmap', default='data/hcl_bm.dat')
+    args = parser.parse_args()
+    unknown = set(args.checks) - set(i[0] for i in CHECKS)
+    if unknown:
+        parser.error('unknown checks: %s' % ', '.join(sorted(unknown)))
+
+    failed = 0
+    for name, check in CHECKS:
+        if args.checks and name not in args.checks:
+            continue
+        for key, (cases, failures) in sorted(check(args.movdata, args.bsmap).items()):
+            print '%-44s %6d cases  %6d failures %s' % (
+                ' '.join(key), cases, failures, 'ok' if failures == 0 else 'FAIL')
+            failed += failures
+    sys.exit(1 if failed else 0)
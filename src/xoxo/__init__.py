@@ -18,4 +18,11 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 from settings import *
-from utils import *
\ No newline at end of file
+from utils import *
+from mobgraph import *
+from spatial import *
+from oppmap import *
+from simulation import *
+from geo import *
+from resources import *
+from sketch import *
@@ -17,6 +17,8 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+import numpy as np
+
 
 class BaseStationMap(object):
     """ A singleton to store mobile network topology
@@ -46,3 +48,11 @@ class BaseStationMap(object):
 
     def get_all_coordinates(self):
         return self._mapDB.values()
+
+    def get_arrays(self):
+        """ All station ids and their (lon, lat) coordinates as arrays,
+        sorted by id.
+        """
+        ids = np.array(sorted(self._mapDB.keys()), dtype=np.int64)
+        coords = np.array([self._mapDB[i] for i in ids.tolist()], dtype=np.float64).reshape(-1, 2)
+        return ids, coords
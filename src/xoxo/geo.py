@@ -0,0 +1,134 @@
+# Copyright (C) 2015, Xiaming Chen chen@xiaming.me
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import numpy as np
+
+
+__all__ = ['EARTH_R', 'greate_circle_distance', 'cdist', 'hop_distances',
+           'cumulative_distance', 'path_length', 'LocalProjection']
+
+
+EARTH_R = 6372.8
+
+
+def greate_circle_distance(lon0, lat0, lon1, lat1, radius=EARTH_R, dtype=np.float64):
+    """Return the distance (in km) between points given in degrees, by the
+    haversine formula. Inputs broadcast; `dtype` selects the precision.
+
+    This is the geodesy kernel of the package, every distance goes
+    through it.
+    """
+    lon0, lat0, lon1, lat1 = [np.asarray(i, dtype=np.float64) for i in (lon0, lat0, lon1, lat1)]
+    # Differences are taken in float64 so that float32 keeps the precision
+    # of short distances between large coordinates.
+    dlon = np.radians(lon1 - lon0).astype(dtype)
+    dlat = np.radians(lat1 - lat0).astype(dtype)
+    lat0 = np.radians(lat0).astype(dtype)
+    lat1 = np.radians(lat1).astype(dtype)
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat0) * np.cos(lat1) * np.sin(dlon / 2) ** 2
+    return (2 * radius) * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+
+def cdist(a, b, radius=EARTH_R, dtype=np.float64):
+    """ Pairwise distances (km) between the (n, 2) and (m, 2) arrays of
+    (lon, lat) `a` and `b`, as an (n, m) array.
+    """
+    a = np.asarray(a, dtype=np.float64).reshape(-1, 2)
+    b = np.asarray(b, dtype=np.float64).reshape(-1, 2)
+    return greate_circle_distance(a[:, 0:1], a[:, 1:2], b[np.newaxis, :, 0], b[np.newaxis, :, 1],
+                                  radius, dtype)
+
+
+def hop_distances(coordinates, radius=EARTH_R, dtype=np.float64):
+    """ Distances between successive points of a list of [(lons, lats)]
+    or an (n, 2) array.
+    """
+    coords = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+    return greate_circle_distance(coords[:-1, 0], coords[:-1, 1], coords[1:, 0], coords[1:, 1],
+                                  radius, dtype)
+
+
+def cumulative_distance(coordinates, radius=EARTH_R, dtype=np.float64):
+    """ Prefix sums of hop distances along a path: element i is the length
+    from the first point to point i, so the length between points i and
+    j is c[j] - c[i].
+    """
+    hops = hop_distances(coordinates, radius, dtype)
+    return np.concatenate([np.zeros(1, hops.dtype), np.cumsum(hops)])
+
+
+def path_length(coordinates, radius=EARTH_R, dtype=np.float64):
+    """ Total length of a path of (lon, lat) points, 0 for fewer than two.
+    """
+    return cumulative_distance(coordinates, radius, dtype)[-1]
+
+
+class LocalProjection(object):
+    """ Equirectangular projection around (lon0, lat0) to a plane in km.
+
+    East-west scale is exact only at lat0; the relative distance error grows
+    by about tan(lat0) per radian of latitude away from it, i.e. roughly
+    0.1% per 0.1 degree at 30N. That is fine for city-scale data and
+    costs a subtraction and a multiply per point. Coordinates are centred
+    in float64 before any cast, so float32 keeps metre precision.
+    """
+
+    def __init__(self, lon0, lat0, radius=EARTH_R, dtype=np.float64):
+        self.lon0 = float(lon0)
+        self.lat0 = float(lat0)
+        self.dtype = dtype
+        self.ky = radius * np.pi / 180
+        self.kx = self.ky * np.cos(np.radians(self.lat0))
+
+    @classmethod
+    def around(cls, coordinates, radius=EARTH_R, dtype=np.float64):
+        """ Projection centred on the mean of a set of (lon, lat) points.
+        """
+        lon0, lat0 = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2).mean(axis=0)
+        return cls(lon0, lat0, radius, dtype)
+
+    def project(self, coordinates):
+        """ (n, 2) array of planar (x, y) km for (lon, lat) points.
+        """
+        coords = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+        xy = np.empty(coords.shape, self.dtype)
+        xy[:, 0] = (coords[:, 0] - self.lon0) * self.kx
+        xy[:, 1] = (coords[:, 1] - self.lat0) * self.ky
+        return xy
+
+    def distance(self, a, b):
+        """ Planar distances between matching rows of two point arrays.
+        """
+        d = self.project(a) - self.project(b)
+        return np.sqrt(np.sum(d * d, axis=1))
+
+    def cdist(self, a, b):
+        """ Planar pairwise distances as an (n, m) array.
+        """
+        a = self.project(a)
+        b = self.project(b)
+        dx = a[:, 0:1] - b[np.newaxis, :, 0]
+        dy = a[:, 1:2] - b[np.newaxis, :, 1]
+        return np.sqrt(dx * dx + dy * dy)
+
+    def nearest(self, points, query):
+        """ Index of the point nearest to each query point.
+        """
+        return np.argmin(self.cdist(query, points), axis=1)
+
@@ -3,6 +3,8 @@ from munkres import Munkres
 import networkx as nx
 import numpy as np
 
+from mobgraph import MobGraph
+
 
 __author__ = 'Xiaming'
 
@@ -11,6 +13,7 @@ class Mesos(object):
     """ Extract mesostructure for two mobility graphs.
     """
     def __init__(self, G1, G2, nattr='weight', eattr='weight', lamb = 0.5):
+        G1, G2 = [G.to_networkx(nattr, eattr) if isinstance(G, MobGraph) else G for G in (G1, G2)]
         G1, G2 = sorted([G1, G2], key=lambda x: len(x))
         csim = gs.tacsim_combined_in_C(G1, G2, node_attribute=nattr, edge_attribute=eattr, lamb=lamb)
         self.csim = csim / np.sqrt(((csim * csim).sum())) # to ensure valid structural distance
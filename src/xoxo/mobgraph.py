@@ -0,0 +1,163 @@
+# Copyright (C) 2015, Xiaming Chen chen@xiaming.me
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import numpy as np
+import networkx as nx
+
+
+__all__ = ['MobGraph']
+
+
+class MobGraph(object):
+    """ A compact directed mobility graph held in flat arrays.
+
+    Nodes are either (lon, lat) coordinates, stored as an (n, 2) float
+    array, or integer location ids, stored as an (n,) int array. Edge
+    endpoints are indices into the node array. Missing weights are NaN.
+    """
+
+    __slots__ = ('nodes', 'node_weight', 'src', 'dst', 'edge_weight', 'edge_freq')
+
+    def __init__(self, nodes, node_weight=None, src=None, dst=None,
+                 edge_weight=None, edge_freq=None):
+        nodes = np.asarray(nodes)
+        if nodes.ndim == 2:
+            nodes = nodes.astype(np.float64)
+        else:
+            nodes = nodes.astype(np.int64).reshape(-1)
+        n = len(nodes)
+        src = np.zeros(0, np.int32) if src is None else np.asarray(src, np.int32)
+        dst = np.zeros(0, np.int32) if dst is None else np.asarray(dst, np.int32)
+        m = len(src)
+        assert len(dst) == m
+
+        self.nodes = nodes
+        self.node_weight = self._filled(node_weight, n, np.nan)
+        self.src = src
+        self.dst = dst
+        self.edge_weight = self._filled(edge_weight, m, np.nan)
+        self.edge_freq = self._filled(edge_freq, m, 1).astype(np.int32)
+
+    @staticmethod
+    def _filled(values, n, default):
+        if values is None:
+            return np.full(n, default, np.float64)
+        values = np.array([default if v is None else v for v in values], np.float64)
+        assert len(values) == n
+        return values
+
+    @classmethod
+    def from_sequence(cls, seq):
+        """ Create a graph from an ordered sequence of items, the compact
+        counterpart of :func:`xoxo.utils.seq2graph`. Nodes keep the order of
+        their first appearance; repeated transitions are counted in
+        `edge_freq`.
+        """
+        seq = [i for i in seq]
+        index = {}
+        nodes = []
+        for i in seq:
+            if i not in index:
+                index[i] = len(nodes)
+                nodes.append(i)
+
+        seen = {}
+        src = []
+        dst = []
+        freq = []
+        for a, b in zip(seq[:-1], seq[1:]):
+            if a == b:
+                continue
+            edge = (index[a], index[b])
+            if edge in seen:
+                freq[seen[edge]] += 1
+            else:
+                seen[edge] = len(src)
+                src.append(edge[0])
+                dst.append(edge[1])
+                freq.append(1)
+
+        return cls(nodes, src=src, dst=dst, edge_freq=freq)
+
+    @classmethod
+    def from_networkx(cls, G, node_attribute='weight', edge_attribute='weight'):
+        """ Convert a networkx graph built by `convert2graph` or `seq2graph`.
+        """
+        nodes = G.nodes()
+        index = dict(zip(nodes, range(len(nodes))))
+        edges = G.edges(data=True)
+        return cls(
+            nodes,
+            [G.node[n].get(node_attribute) for n in nodes],
+            [index[e[0]] for e in edges],
+            [index[e[1]] for e in edges],
+            [e[2].get(edge_attribute) for e in edges],
+            [e[2].get('frequency', 1) for e in edges])
+
+    def is_coordinate(self):
+        return self.nodes.ndim == 2
+
+    def node_list(self):
+        """ Node labels as hashable python objects, i.e. tuples or ints.
+        """
+        if self.is_coordinate():
+            return [tuple(i) for i in self.nodes.tolist()]
+        return self.nodes.tolist()
+
+    def number_of_nodes(self):
+        return len(self.nodes)
+
+    def number_of_edges(self):
+        return len(self.src)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def in_degree(self):
+        return np.bincount(self.dst, minlength=len(self.nodes))
+
+    def out_degree(self):
+        return np.bincount(self.src, minlength=len(self.nodes))
+
+    def degree(self):
+        """ Total (in + out) degree of each node as an array, in node order.
+        """
+        return self.in_degree() + self.out_degree()
+
+    def nbytes(self):
+        """ Memory held by the underlying arrays.
+        """
+        return sum(getattr(self, i).nbytes for i in self.__slots__)
+
+    def to_networkx(self, node_attribute='weight', edge_attribute='weight'):
+        """ Return the equivalent networkx DiGraph with `weight` and
+        `frequency` attributes as produced by `convert2graph`.
+        """
+        nodes = self.node_list()
+        G = nx.DiGraph()
+        for n, w in zip(nodes, self.node_weight.tolist()):
+            G.add_node(n)
+            if not np.isnan(w):
+                G.node[n][node_attribute] = w
+        for s, t, w, f in zip(self.src.tolist(), self.dst.tolist(),
+                              self.edge_weight.tolist(), self.edge_freq.tolist()):
+            G.add_edge(nodes[s], nodes[t], frequency=f)
+            if not np.isnan(w):
+                G.edge[nodes[s]][nodes[t]][edge_attribute] = w
+        return G
@@ -2,50 +2,357 @@
 # -*- encoding: utf-8
 __author__ = 'chenxm'
 
+import os
+import struct
+import pickle
+import binascii
+import itertools
+
 import numpy as np
 from pandas import DataFrame
 import networkx as nx
 from networkx.algorithms import isomorphism
 
+from mobgraph import MobGraph
+from settings import CACHE_DIR
+
+
+# Directed graphs up to this size are labelled by catalogue lookup
+CATALOGUE_MAX_NODES = 5
+
+
+def _adjacency(g):
+    """ Return (number of nodes, successor lists, predecessor lists, directed)
+    of a networkx graph or MobGraph, with nodes replaced by indices.
+    """
+    if isinstance(g, MobGraph):
+        n = g.number_of_nodes()
+        succ = [[] for i in range(n)]
+        pred = [[] for i in range(n)]
+        for s, t in zip(g.src.tolist(), g.dst.tolist()):
+            succ[s].append(t)
+            pred[t].append(s)
+        return n, succ, pred, True
+
+    nodes = g.nodes()
+    index = dict(zip(nodes, range(len(nodes))))
+    succ = [[index[u] for u in g.successors(v)] if g.is_directed() else
+            [index[u] for u in g.neighbors(v)] for v in nodes]
+    if g.is_directed():
+        pred = [[index[u] for u in g.predecessors(v)] for v in nodes]
+    else:
+        pred = succ
+    return len(nodes), succ, pred, g.is_directed()
+
+
+def _refine(colors, succ, pred):
+    """ Colour refinement (1-dimensional Weisfeiler-Lehman) of an ordered
+    vertex partition. Colours are ranks of isomorphism-invariant signatures,
+    so equal inputs on isomorphic graphs give equal outputs.
+    """
+    ncolor = len(set(colors))
+    while True:
+        sigs = [(colors[v],
+                 tuple(sorted([colors[u] for u in succ[v]])),
+                 tuple(sorted([colors[u] for u in pred[v]])))
+                for v in range(len(colors))]
+        rank = dict((sig, i) for i, sig in enumerate(sorted(set(sigs))))
+        colors = [rank[sig] for sig in sigs]
+        if len(rank) == ncolor:
+            return colors
+        ncolor = len(rank)
+
+
+def _orbits(gens, n):
+    """ Orbit representative of each vertex under the group generated by
+    the permutations `gens`.
+    """
+    parent = list(range(n))
+
+    def find(v):
+        while parent[v] != v:
+            parent[v] = parent[parent[v]]
+            v = parent[v]
+        return v
+
+    for gen in gens:
+        for v in range(n):
+            a, b = find(v), find(gen[v])
+            if a != b:
+                parent[max(a, b)] = min(a, b)
+    return [find(v) for v in range(n)]
+
+
+def _canonical_code(n, succ, pred):
+    """ Smallest adjacency bitmask over the leaves of the
+    individualisation-refinement search tree. Branches equivalent under
+    twin swaps or automorphisms found at earlier leaves are pruned.
+    """
+    state = {'first': None, 'best': None, 'gens': []}
+    succs = [set(i) for i in succ]
+    preds = [set(i) for i in pred]
+
+    def twins(u, v):
+        # Swapping u and v is an automorphism fixing all other vertices
+        return (v in succs[u]) == (u in succs[v]) and \
+            succs[u] - set([v]) == succs[v] - set([u]) and \
+            preds[u] - set([v]) == preds[v] - set([u])
+
+    def leaf(colors):
+        code = 0
+        for v in range(n):
+            for u in succ[v]:
+                code |= 1 << (colors[v] * n + colors[u])
+
+        for ref in (state['first'], state['best']):
+            if ref is not None and ref[0] == code:
+                # Same code at two leaves gives an automorphism of the graph
+                inverse = [0] * n
+                for v in range(n):
+                    inverse[colors[v]] = v
+                gen = [inverse[ref[1][v]] for v in range(n)]
+                if gen != list(range(n)):
+                    state['gens'].append(gen)
+                break
+        if state['first'] is None:
+            state['first'] = (code, colors)
+        if state['best'] is None or code < state['best'][0]:
+            state['best'] = (code, colors)
+
+    def search(colors, prefix):
+        colors = _refine(colors, succ, pred)
+        if len(set(colors)) == n:
+            return leaf(colors)
+
+        # Individualise each vertex of the first non-singleton cell in turn
+        sizes = {}
+        for c in colors:
+            sizes[c] = sizes.get(c, 0) + 1
+        target = min(c for c in sizes if sizes[c] > 1)
+        explored = []
+        for v in range(n):
+            if colors[v] != target:
+                continue
+            if any(twins(v, w) for w in explored):
+                continue
+            if explored and state['gens']:
+                gens = [g for g in state['gens'] if all(g[p] == p for p in prefix)]
+                orbit = _orbits(gens, n)
+                if orbit[v] in set(orbit[w] for w in explored):
+                    continue
+            explored.append(v)
+            branch = [2 * c for c in colors]
+            branch[v] -= 1
+            search(branch, prefix + [v])
+
+    search([0] * n, [])
+    return state['best'][0]
+
+
+def _bit(i, j, n):
+    """ Bit of edge i->j in the adjacency bitmask of a loop-free digraph.
+    """
+    return i * (n - 1) + (j if j < i else j - 1)
+
+
+def _build_catalogue(n):
+    """ Enumerate all loop-free digraphs on n nodes as adjacency bitmasks and
+    group them into isomorphism classes by the smallest mask over all node
+    permutations. Return (class id of each mask, canonical code per class).
+    """
+    nbits = n * (n - 1)
+    masks = np.arange(1 << nbits, dtype=np.uint32)
+    edges = [(i, j) for i in range(n) for j in range(n) if i != j]
+    least = masks.copy()
+    for perm in itertools.permutations(range(n)):
+        permuted = np.zeros_like(masks)
+        for i, j in edges:
+            permuted |= ((masks >> _bit(i, j, n)) & 1) << _bit(perm[i], perm[j], n)
+        np.minimum(least, permuted, out=least)
+    reprs, ids = np.unique(least, return_inverse=True)
+
+    codes = np.zeros(len(reprs), dtype=np.int64)
+    for k, mask in enumerate(reprs.tolist()):
+        succ = [[j for j in range(n) if j != i and mask >> _bit(i, j, n) & 1]
+                for i in range(n)]
+        pred = [[i for i in range(n) if i != j and mask >> _bit(i, j, n) & 1]
+                for j in range(n)]
+        codes[k] = _canonical_code(n, succ, pred)
+    return ids.astype(np.uint16), codes
+
+
+_catalogues = {}
+
+
+def motif_catalogue(n, cache_dir=CACHE_DIR):
+    """ Lookup tables of directed motifs with n nodes, see
+    :func:`_build_catalogue`. Tables are built once and cached on disk
+    as `motif-catalogue-<n>.npz` in `cache_dir`; when the cache cannot be
+    written, e.g. with xoxo imported from a zip on Spark executors, they
+    are kept in memory only.
+    """
+    if n not in _catalogues:
+        path = os.path.join(cache_dir, 'motif-catalogue-%d.npz' % n)
+        if os.path.exists(path):
+            data = np.load(path)
+            ids, codes = data['ids'], data['codes']
+        else:
+            ids, codes = _build_catalogue(n)
+            try:
+                if not os.path.exists(cache_dir):
+                    os.makedirs(cache_dir)
+                # Readers only ever see complete tables
+                tmp = '%s.%d.tmp' % (path, os.getpid())
+                with open(tmp, 'wb') as ofile:
+                    np.savez(ofile, ids=ids, codes=codes)
+                os.rename(tmp, path)
+            except (OSError, IOError):
+                pass
+        _catalogues[n] = (ids, codes.tolist())
+    return _catalogues[n]
+
+
+def canonical_form(g):
+    """ Return a hashable canonical key of a graph (networkx or MobGraph) so
+    that two graphs are isomorphic if and only if their keys are equal.
+
+    The key is (directed, number of nodes, number of edges, adjacency code),
+    where the code is the minimal adjacency bitmask found by colour
+    refinement with individualisation of symmetric vertices. Most mobility
+    graphs are labelled by refinement alone; symmetric ones fall back to
+    branching, pruned by the automorphisms discovered on the way.
+    Loop-free digraphs with at most `CATALOGUE_MAX_NODES` nodes take their
+    code from :func:`motif_catalogue` instead.
+    """
+    n = g.number_of_nodes()
+    if n <= CATALOGUE_MAX_NODES and (isinstance(g, MobGraph) or g.is_directed()):
+        if isinstance(g, MobGraph):
+            edges = zip(g.src.tolist(), g.dst.tolist())
+        else:
+            index = dict(zip(g.nodes(), range(n)))
+            edges = [(index[s], index[t]) for s, t in g.edges()]
+        if all(s != t for s, t in edges):
+            mask = 0
+            for s, t in edges:
+                mask |= 1 << _bit(s, t, n)
+            ids, codes = motif_catalogue(n)
+            return (True, n, len(edges), codes[ids[mask]])
+
+    n, succ, pred, directed = _adjacency(g)
+    nedge = sum(len(i) for i in succ)
+    if not directed:
+        nedge //= 2
+    return (directed, n, nedge, _canonical_code(n, succ, pred))
+
+
+def motif_graph(key):
+    """ Rebuild the motif graph, with nodes 0..n-1 in canonical order, from
+    a key returned by :func:`canonical_form`.
+    """
+    directed, n, nedge, code = key
+    g = nx.DiGraph() if directed else nx.Graph()
+    g.add_nodes_from(range(n))
+    g.add_edges_from((i, j) for i in range(n) for j in range(n)
+                     if code >> (i * n + j) & 1)
+    return g
+
+
+_DUMP_MAGIC = b'MTF\x01'
+_DUMP_RECORD = struct.Struct('<HIBQ')
+
+
+def _code_bytes(nnode):
+    return (nnode * nnode + 7) // 8
+
+
+class MotifLayouts(object):
+    """ Spring layouts of motif graphs memoised by canonical key and
+    persisted with pickle, so that the same motif is laid out once across
+    figures and runs. Layouts start from the circular layout to make them
+    reproducible.
+    """
+
+    def __init__(self, path=os.path.join(CACHE_DIR, 'motif-layouts.pkl')):
+        self.path = path
+        self._pos = {}
+        self._dirty = False
+        if os.path.exists(path):
+            with open(path, 'rb') as ifile:
+                self._pos = pickle.load(ifile)
+
+    def get(self, key):
+        if key not in self._pos:
+            g = motif_graph(key)
+            self._pos[key] = nx.spring_layout(g, pos=nx.circular_layout(g))
+            self._dirty = True
+        return self._pos[key]
+
+    def save(self):
+        if not self._dirty:
+            return
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as ofile:
+            pickle.dump(self._pos, ofile, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, self.path)
+        self._dirty = False
+
 
 class Motif(object):
     """The repeated common parts in human mobility.
     See paper: C. Schneider, “Unravelling daily human mobility motifs,”
     Journal of the Royal Society, Interface / the Royal Society, 2013.
+
+    Graphs are counted by their :func:`canonical_form`, so adding a graph
+    costs one canonical labelling (a table lookup for small graphs) and a
+    dict lookup. Counters are keyed by canonical keys only, which keeps
+    the pickled state small and lets partial counters be merged.
     """
 
     def __init__(self, n = None):
-        self.all = {}
+        self.all = {}       # nnode -> nedge -> canonical key -> count
         self.n = n
+        self._graphs = {}   # canonical key -> motif graph, built on demand
+
+    def __getstate__(self):
+        return {'all': self.all, 'n': self.n}
+
+    def __setstate__(self, state):
+        self.all = state['all']
+        self.n = state['n']
+        self._graphs = {}
 
     def add_graph(self, g):
         """Add a new graph to our motifs if it is new"""
-        assert isinstance(g, nx.Graph)
+        assert isinstance(g, (nx.Graph, MobGraph))
 
         nnode = g.number_of_nodes()
         if self.n is not None and nnode != self.n:
             return  # when it does not satisfy our target motif
 
-        motifs = self.all
-        if nnode not in motifs:
-            motifs[nnode] = {}
+        self.add_key(canonical_form(g))
 
-        nedge = g.number_of_edges()
-        motifs2 = motifs[nnode]
-        if nedge not in motifs2:
-            motifs2[nedge] = {g: 1}
-        else:
-            # TODO: optimize the isomorphic searching
-            preds = motifs2[nedge].keys()
-            found = False
-            for ig in preds:
-                if self.is_isomorphic(g, ig):
-                    found = True
-                    break
-            if found:
-                motifs2[nedge][ig] += 1
-            else: # its a new motif
-                motifs2[nedge].update({g: 1})
+    def add_key(self, key, count=1):
+        """Count a graph given by its canonical key"""
+        motifs = self.all.setdefault(key[1], {}).setdefault(key[2], {})
+        motifs[key] = motifs.get(key, 0) + count
+
+    def merge(self, other):
+        """Add the counts of another Motif into this one and return self"""
+        assert self.n == other.n
+        for nn in other.all:
+            for ne in other.all[nn]:
+                for key, count in other.all[nn][ne].items():
+                    self.add_key(key, count)
+        return self
+
+    def motif(self, key):
+        """Return the motif graph of a canonical key"""
+        if key not in self._graphs:
+            self._graphs[key] = motif_graph(key)
+        return self._graphs[key]
 
     def is_isomorphic(self, g1, g2, approximate=False):
         """Check if two graphs are isomorphic.
@@ -61,16 +368,8 @@ class Motif(object):
                     return True
             return False
 
-    def motif_iter(self, nnode=None):
-        """Iterator over all motifs with specific number of nodes.
-
-        Parameters
-        ----------
-        nnode: integer or list, optional
-            If it is an integer, return motifs with the number of nodes.
-            If it is a list of integer, return all motifs whose number falls
-            into the list.
-            If it is None, return all motifs without constraints.
+    def key_iter(self, nnode=None):
+        """Iterator over (canonical key, count) of motifs, see :meth:`motif_iter`.
         """
         if nnode is None:
             nnodes = self.all.keys()
@@ -80,11 +379,25 @@ class Motif(object):
             nnodes = nnode
 
         for nn in nnodes:
-            motifs = self.all[nn]
+            motifs = self.all.get(nn, {})
             for ne in motifs.keys():
                 motifs2 = motifs[ne]
-                for motif in motifs2.keys():
-                    yield (motif, motifs2[motif])
+                for key in motifs2.keys():
+                    yield (key, motifs2[key])
+
+    def motif_iter(self, nnode=None):
+        """Iterator over all motifs with specific number of nodes.
+
+        Parameters
+        ----------
+        nnode: integer or list, optional
+            If it is an integer, return motifs with the number of nodes.
+            If it is a list of integer, return all motifs whose number falls
+            into the list.
+            If it is None, return all motifs without constraints.
+        """
+        for key, count in self.key_iter(nnode):
+            yield (self.motif(key), count)
 
     def all_motifs(self, nnode=None, order_by_size=False, reverse=False):
         """Return a list of tuple (motif, count) with specifc number of nodes.
@@ -97,19 +410,68 @@ class Motif(object):
     def number_of_motifs(self, nnode=None):
         """Return the number of motifs with specifc number of nodes.
         """
-        counter = [cnt for motif, cnt in self.motif_iter(nnode)]
+        counter = [cnt for key, cnt in self.key_iter(nnode)]
         return np.sum(counter)
 
     def stat(self):
         """Generate the stat of deteced motifs.
         """
         columns=['nnode', 'motifidx', 'count']
-        result = DataFrame(columns=columns)
+        nnodes = []
+        counts = []
+        motifidx = []
         for nn in self.all:
-            motifs = self.all_motifs(nn, True)
-            for i in range(len(motifs)):
-                result = result.append(
-                    DataFrame(np.array([[nn, i, motifs[i][1]]]), columns=columns),
-                    ignore_index=True)
+            cnt = sorted(c for motifs in self.all[nn].values() for c in motifs.values())
+            nnodes.extend([nn] * len(cnt))
+            motifidx.extend(range(len(cnt)))
+            counts.extend(cnt)
+
+        return DataFrame({'nnode': np.array(nnodes, dtype=np.int64),
+                          'motifidx': np.array(motifidx, dtype=np.int64),
+                          'count': np.array(counts, dtype=np.int64)},
+                         columns=columns)
 
-        return result
\ No newline at end of file
+    def dump_counts(self, ofile, binary=False):
+        """Stream the motif counts with their canonical keys to an open file.
+
+        The CSV format has a header line `nnode,nedge,directed,code,count`
+        with the adjacency code in hex. The binary format starts with
+        `_DUMP_MAGIC` followed by one record per motif: a `_DUMP_RECORD`
+        header (nnode, nedge, directed, count) and ceil(nnode^2 / 8) bytes
+        of big-endian adjacency code.
+        """
+        if binary:
+            ofile.write(_DUMP_MAGIC)
+        else:
+            ofile.write('nnode,nedge,directed,code,count\n')
+        for nn in self.all:
+            for ne in self.all[nn]:
+                for key, count in self.all[nn][ne].items():
+                    directed, nnode, nedge, code = key
+                    if binary:
+                        ofile.write(_DUMP_RECORD.pack(nnode, nedge, directed, count))
+                        ofile.write(binascii.unhexlify('%0*x' % (2 * _code_bytes(nnode), code)))
+                    else:
+                        ofile.write('%d,%d,%d,%x,%d\n' % (nnode, nedge, directed, code, count))
+
+    @classmethod
+    def load_counts(cls, ifile, n=None):
+        """Read counts written by :meth:`dump_counts` in either format.
+        """
+        motifrepo = cls(n)
+        head = ifile.read(len(_DUMP_MAGIC))
+        if head == _DUMP_MAGIC:
+            while True:
+                record = ifile.read(_DUMP_RECORD.size)
+                if not record:
+                    break
+                nnode, nedge, directed, count = _DUMP_RECORD.unpack(record)
+                code = int(binascii.hexlify(ifile.read(_code_bytes(nnode))) or '0', 16)
+                motifrepo.add_key((bool(directed), nnode, nedge, code), count)
+        else:
+            ifile.readline()    # rest of the CSV header
+            for line in ifile:
+                nnode, nedge, directed, code, count = line.strip('\r\n').split(',')
+                motifrepo.add_key((bool(int(directed)), int(nnode), int(nedge), int(code, 16)),
+                                  int(count))
+        return motifrepo
\ No newline at end of file
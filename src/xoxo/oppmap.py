@@ -0,0 +1,211 @@
+# Copyright (C) 2015, Xiaming Chen chen@xiaming.me
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import os
+import hashlib
+
+import numpy as np
+import networkx as nx
+
+from settings import CACHE_DIR
+from geo import greate_circle_distance
+from spatial import SpatialIndex
+
+
+__all__ = ['load_oppmap', 'oppmap_graph', 'SparseDistanceTable', 'distance_table']
+
+
+def _file_digest(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _build_oppmap(flowmap, bsmap, threshold):
+    """ Aggregate a flowmap of `interval,src,dst,total,unique` lines into
+    opportunity nodes keyed by coordinates.
+    """
+    flows = np.loadtxt(flowmap, delimiter=',', dtype=np.int64, ndmin=2).reshape(-1, 5)
+    src, dst, unique = flows[:, 1], flows[:, 2], flows[:, 4]
+
+    ids, coords = bsmap.get_arrays()
+    ends = np.concatenate([src, dst])
+    pos = np.minimum(np.searchsorted(ids, ends), len(ids) - 1)
+    missing = ids[pos] != ends
+    if np.any(missing):
+        raise KeyError(int(ends[np.argmax(missing)]))
+
+    # Distinct coordinates of all endpoints; stations sharing a position
+    # collapse into one node.
+    nodes, inverse = np.unique(
+        np.ascontiguousarray(coords[pos]).view([('lon', np.float64), ('lat', np.float64)]).ravel(),
+        return_inverse=True)
+    nodes = nodes.view(np.float64).reshape(-1, 2)
+    src_node, dst_node = inverse[:len(src)], inverse[len(src):]
+
+    # Destination weights count every flow, the threshold only selects
+    # which edges (and thus nodes) make up the map.
+    weights = np.bincount(dst_node, weights=unique, minlength=len(nodes)).astype(np.int64)
+
+    keep = np.ones(len(flows), bool) if threshold is None else unique > threshold
+    edges = np.unique(src_node[keep] * len(nodes) + dst_node[keep])
+    edges = np.column_stack([edges // len(nodes), edges % len(nodes)]).reshape(-1, 2)
+    used = np.unique(edges.ravel())
+    remap = np.full(len(nodes), -1, np.int64)
+    remap[used] = np.arange(len(used))
+
+    return nodes[used], weights[used], remap[edges]
+
+
+def load_oppmap(flowmap, bsmap, threshold=None, cache_dir=CACHE_DIR):
+    """ Opportunity map of a flowmap file, i.e. every location that appears
+    in a flow with the total `unique` users arriving there as its weight.
+
+    Only flows with `unique > threshold` contribute nodes when a threshold
+    is given. Returns `(coordinates, weights, edges)` where coordinates
+    is an (n, 2) array of (lon, lat), weights an (n,) array and edges an
+    (m, 2) array of node indices. Results are cached in `cache_dir` keyed
+    by the content of the flowmap, the station map and the threshold.
+    """
+    ids, coords = bsmap.get_arrays()
+    key = hashlib.md5('%s:%s:%s:%s' % (
+        _file_digest(flowmap), hashlib.md5(ids.tostring()).hexdigest(),
+        hashlib.md5(coords.tostring()).hexdigest(), threshold)).hexdigest()
+    path = os.path.join(cache_dir, 'oppmap-%s.npz' % key)
+
+    if os.path.exists(path):
+        data = np.load(path)
+        return data['nodes'], data['weights'], data['edges']
+
+    nodes, weights, edges = _build_oppmap(flowmap, bsmap, threshold)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    np.savez(path, nodes=nodes, weights=weights, edges=edges)
+    return nodes, weights, edges
+
+
+def oppmap_graph(nodes, weights, edges):
+    """ The opportunity map as an undirected networkx graph with (lon, lat)
+    tuples as nodes and a `weight` node attribute.
+    """
+    labels = [tuple(i) for i in nodes.tolist()]
+    graph = nx.Graph()
+    for n, w in zip(labels, weights.tolist()):
+        graph.add_node(n, weight=w)
+    graph.add_edges_from((labels[s], labels[t]) for s, t in edges.tolist())
+    return graph
+
+
+class SparseDistanceTable(object):
+    """ Node x node distances kept only up to a radius, in CSR form with
+    float32 values. Lookups of pairs beyond the radius fall back to
+    :func:`greate_circle_distance`, so `table[rows, cols]` always holds the
+    true distances.
+    """
+
+    def __init__(self, coords, indptr, indices, data, max_radius):
+        self.coords = coords
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.max_radius = max_radius
+        self._keys = None
+
+    @property
+    def shape(self):
+        return len(self.coords), len(self.coords)
+
+    def row(self, i):
+        """ Sorted neighbour indices of node i within the radius and their
+        distances.
+        """
+        s, e = self.indptr[i], self.indptr[i + 1]
+        return self.indices[s:e], self.data[s:e]
+
+    def __getitem__(self, key):
+        rows, cols = np.broadcast_arrays(*[np.asarray(i, np.int64) for i in key])
+        # Entries are sorted by row then column, so (row, column) pairs
+        # map to sorted integer keys.
+        n = len(self.coords)
+        if self._keys is None:
+            entry_rows = np.repeat(np.arange(n, dtype=np.int64), np.diff(self.indptr))
+            self._keys = entry_rows * n + self.indices
+        keys = rows * n + cols
+        pos = np.minimum(np.searchsorted(self._keys, keys), max(len(self._keys) - 1, 0))
+        hit = self._keys[pos] == keys if len(self._keys) else np.zeros(keys.shape, bool)
+        out = np.empty(keys.shape, np.float32)
+        out[hit] = self.data[pos[hit]]
+        rmiss, cmiss = rows[~hit], cols[~hit]
+        out[~hit] = greate_circle_distance(self.coords[rmiss, 0], self.coords[rmiss, 1],
+                                           self.coords[cmiss, 0], self.coords[cmiss, 1])
+        return out
+
+
+def _build_sparse(coords, max_radius):
+    index = SpatialIndex(coords, cell_km=max(max_radius, 0.1))
+    indptr = [0]
+    indices = []
+    data = []
+    for lon, lat in coords.tolist():
+        nbrs, dist = index.query_radius(lon, lat, max_radius, return_distance=True)
+        order = np.argsort(nbrs)
+        indices.append(nbrs[order])
+        data.append(dist[order])
+        indptr.append(indptr[-1] + len(nbrs))
+    cat = lambda parts, dtype: np.concatenate(parts).astype(dtype) if parts else np.zeros(0, dtype)
+    return np.array(indptr, np.int64), cat(indices, np.int32), cat(data, np.float32)
+
+
+def distance_table(nodes, max_radius=None, block=1024, cache_dir=CACHE_DIR):
+    """ Great circle distances (km) among opportunity map nodes, computed
+    once and cached in `cache_dir` keyed by the node coordinates.
+
+    Without `max_radius` this is a dense float32 (n, n) array memory
+    mapped read-only from disk, filled `block` rows at a time. With it,
+    only pairs within `max_radius` km are stored, see
+    :class:`SparseDistanceTable`.
+    """
+    coords = np.ascontiguousarray(nodes, dtype=np.float64).reshape(-1, 2)
+    n = len(coords)
+    key = hashlib.md5(coords.tostring()).hexdigest()
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    if max_radius is not None:
+        path = os.path.join(cache_dir, 'oppmap-dist-%s-%g.npz' % (key, max_radius))
+        if not os.path.exists(path):
+            indptr, indices, data = _build_sparse(coords, max_radius)
+            np.savez(path, indptr=indptr, indices=indices, data=data)
+        arrs = np.load(path)
+        return SparseDistanceTable(coords, arrs['indptr'], arrs['indices'], arrs['data'], max_radius)
+
+    path = os.path.join(cache_dir, 'oppmap-dist-%s.f32' % key)
+    if not os.path.exists(path):
+        tmp = path + '.tmp'
+        table = np.memmap(tmp, dtype=np.float32, mode='w+', shape=(n, n))
+        for i in range(0, n, block):
+            rows = coords[i:i + block]
+            table[i:i + block] = greate_circle_distance(
+                rows[:, 0:1], rows[:, 1:2], coords[np.newaxis, :, 0], coords[np.newaxis, :, 1])
+        table.flush()
+        del table
+        os.rename(tmp, path)
+    return np.memmap(path, dtype=np.float32, mode='r', shape=(n, n))
@@ -6,7 +6,9 @@ from typedecorator import params, returns
 from roadnet import RoadNetwork
 from bsmap import BaseStationMap
 from settings import HZ_LB, HZ_RT
-from utils import greate_circle_distance, seq2graph, drange, in_area
+from utils import seq2graph, drange, in_area, radius_of_gyration, travel_distance
+from mobgraph import MobGraph
+from geo import greate_circle_distance
 
 
 __all__ = ['movement_reader', 'PersonMoveDay']
@@ -70,14 +72,16 @@ def movement_reader(ifile, bsmap):
 
 
 def transtime(a, b):
-    dist = greate_circle_distance(a[0], a[1], b[0], b[1])
-    if dist <= 5: # km
-        speed = 5
-    elif dist <= 15:
-        speed = 20
-    else:
-        speed = 30
-    return 1.0 * dist / speed * 3600
+    """ Travel time (secs) between (lon, lat) points, or between the rows
+    of two (n, 2) arrays, at 5, 20 or 30 km/h for trips up to 5, up to 15
+    and over 15 km.
+    """
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    dist = greate_circle_distance(a[..., 0], a[..., 1], b[..., 0], b[..., 1])
+    speed = np.where(dist <= 5, 5, np.where(dist <= 15, 20, 30))
+    secs = 1.0 * dist / speed * 3600
+    return float(secs) if secs.ndim == 0 else secs
 
 
 class PersonMoveDay(object):
@@ -226,25 +230,39 @@ class PersonMoveDay(object):
 
         return graph
 
+    @params(self=object, road_network=RoadNetwork)
+    def convert2mobgraph(self, road_network=None):
+        """ Return the same weighted graph as :meth:`convert2graph` in the
+        compact array form of :class:`MobGraph`.
+        """
+        graph = MobGraph.from_sequence(self.coordinates)
+        nodes = graph.nodes
+
+        if graph.number_of_edges() > 0:
+            if road_network:
+                coords = graph.node_list()
+                graph.edge_weight = np.array([
+                    road_network.shortest_path_distance(coords[s], coords[t])
+                    for s, t in zip(graph.src, graph.dst)])
+            else:
+                graph.edge_weight = greate_circle_distance(
+                    nodes[graph.src, 0], nodes[graph.src, 1],
+                    nodes[graph.dst, 0], nodes[graph.dst, 1])
+
+        graph.node_weight = np.array(
+            [self.accdwelling.get(n) for n in graph.node_list()], dtype=np.float64)
+
+        return graph
+
     def radius_of_gyration(self):
         """ R_g based on edge distances
         """
-        clon = np.average([coord[0] for coord in self.coordinates])
-        clat = np.average([coord[1] for coord in self.coordinates])
-
-        return np.average([greate_circle_distance(clon, clat, coord[0], coord[1]) for coord in self.coordinates])
+        return radius_of_gyration(self.coordinates)
 
     def travel_dist(self):
         """ Calculate the travelling distance totally.
         """
-        if len(self.coordinates) < 2:
-            return 0
-        total = 0
-        for i in range(0, len(self.coordinates)-1):
-            lon1, lat1 = self.coordinates[i]
-            lon2, lat2 = self.coordinates[i+1]
-            total += greate_circle_distance(lon1, lat1, lon2, lat2)
-        return total
+        return travel_distance(self.coordinates)
 
     def distinct_loc_num(self):
         return len(set(self.locations))
@@ -0,0 +1,114 @@
+# Copyright (C) 2015, Xiaming Chen chen@xiaming.me
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import os
+import glob
+
+from bsmap import BaseStationMap
+
+
+__all__ = ['ship_file', 'locate_file', 'shared_bsmap', 'shared_roadnet', 'parse_records',
+           'sort_by_user', 'sorted_records']
+
+
+# Resources loaded in this process, keyed by (kind, file name)
+_resources = {}
+
+
+def ship_file(sc, path):
+    """ Distribute a file to all Spark executors and return the name to
+    load it by. Shapefiles are shipped with their sibling .shx/.dbf/...
+    files.
+    """
+    if path.endswith('.shp'):
+        for sibling in glob.glob(os.path.splitext(path)[0] + '.*'):
+            sc.addFile(sibling)
+    else:
+        sc.addFile(path)
+    return os.path.basename(path)
+
+
+def locate_file(name):
+    """ Local path of a file given by path, or by the name of a file
+    shipped with :func:`ship_file`.
+    """
+    if os.path.exists(name):
+        return name
+    from pyspark import SparkFiles
+    return SparkFiles.get(name)
+
+
+def _shared(kind, name, loader):
+    key = (kind, name)
+    if key not in _resources:
+        _resources[key] = loader(locate_file(name))
+    return _resources[key]
+
+
+def shared_bsmap(name):
+    """ The BaseStationMap of a file, loaded once per process.
+    """
+    return _shared('bsmap', name, BaseStationMap)
+
+
+def shared_roadnet(name):
+    """ The RoadNetwork of a shapefile, loaded once per process; None
+    when no name is given.
+    """
+    if name is None:
+        return None
+    from roadnet import RoadNetwork
+    return _shared('roadnet', name, RoadNetwork)
+
+
+def parse_records(lines):
+    """ Parse `uid,ts,bid` movement lines into (uid, ts, bid) tuples,
+    skipping comments and blank lines.
+    """
+    for line in lines:
+        line = line.strip('\r\n ')
+        if not line or line.startswith('#'):
+            continue
+        uid, ts, bid = line.split(',')[0:3]
+        yield (int(uid), float(ts), int(bid))
+
+
+def _user_partition(key):
+    from pyspark.rdd import portable_hash
+    return portable_hash(key[0])
+
+
+def sort_by_user(records, num_partitions=None):
+    """ Shuffle an RDD of (uid, ts, bid) records so that all records of a
+    user land in one partition, sorted by (uid, ts). Records travel as
+    ((uid, ts), bid) pairs and no per-user lists are built; read the
+    partitions back with :func:`sorted_records`.
+    """
+    if num_partitions is None:
+        num_partitions = records.getNumPartitions()
+    return records.map(lambda r: ((r[0], r[1]), r[2]))\
+        .repartitionAndSortWithinPartitions(num_partitions, _user_partition)
+
+
+def sorted_records(pairs):
+    """ (uid, ts, bid) records of a partition of :func:`sort_by_user`, in
+    order, ready for :func:`xoxo.permov.movement_reader`.
+    """
+    for (uid, ts), bid in pairs:
+        yield (uid, ts, bid)
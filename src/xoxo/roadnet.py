@@ -22,7 +22,7 @@ import json
 import numpy as np
 import networkx as nx
 
-from utils import greate_circle_distance
+from geo import greate_circle_distance, LocalProjection
 
 
 __all__ = ['RoadNetwork']
@@ -43,6 +43,9 @@ class RoadNetwork(object):
                 )
                 mg.edge[n0][n1]['distance'] = distance
         self.graph = mg
+        self._nodes = mg.nodes()
+        self._projection = LocalProjection.around(self._nodes)
+        self._xy = self._projection.project(self._nodes)
         self._cache = {}
         self._cache_nn = {}
 
@@ -67,9 +70,8 @@ class RoadNetwork(object):
         hit = self._hit_cache_nn(lonlat)
         if hit is not None:
             return hit
-        nodes = np.array(self.graph.nodes())
-        nn = np.argmin(np.sum((nodes[:,:] - lonlat)**2, axis=1))
-        coord = self.graph.nodes()[nn]
+        d = self._xy - self._projection.project(lonlat)
+        coord = self._nodes[np.argmin(np.sum(d * d, axis=1))]
         self._update_cache_nn(lonlat, coord)
         return coord
 
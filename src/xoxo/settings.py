@@ -9,6 +9,9 @@ BSMAP = os.path.join(thisdir, '../../data/hcl_mesos0822_bm.dat')
 HZ_ROADNET = os.path.join(thisdir, '../../map/hz/roads_clean.shp')
 HZ_MOBNET = os.path.join(thisdir, '../../map/hz/mobilenetwork.shp')
 
+# Derived artifacts (lookup tables, layouts, ...) rebuilt when missing
+CACHE_DIR = os.path.join(thisdir, '../../cache')
+
 HZ_LB = [120.03013, 30.13614]
 HZ_RT = [120.28597, 30.35318]
 
@@ -0,0 +1,341 @@
+# Copyright (C) 2015, Xiaming Chen chen@xiaming.me
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import numpy as np
+from multiprocessing import Pool, cpu_count
+
+from geo import greate_circle_distance, hop_distances
+from spatial import SpatialIndex
+
+
+__all__ = ['PersonMap', 'RandomPolicy', 'MaxDistancePolicy', 'Simulator', 'simulate', 'farthest',
+           'farthest_many', 'save_features', 'load_features']
+
+
+class PersonMap(object):
+    """ Candidate selection over a fixed set of opportunity nodes: the
+    nodes that keep the R_g of a trajectory within a bound once added.
+    """
+
+    def __init__(self, nodes, block=4096):
+        self.nodes = list(nodes)
+        self.coords = np.array(self.nodes, dtype=np.float64).reshape(-1, 2)
+        self.block = block
+        self.index = SpatialIndex(self.coords)
+
+    def rg_with(self, curlocs, which=None):
+        """ R_g of [node] + curlocs for every node (or the nodes indexed by
+        `which`), in node order.
+        """
+        locs = np.array(curlocs, dtype=np.float64).reshape(1, -1, 2)
+        which = np.arange(len(self.coords)) if which is None else np.asarray(which)
+        return self.rg_with_many(locs, np.zeros(len(which), np.int64), which)
+
+    def rg_with_many(self, trajs, owner, which):
+        """ R_g of [node which[i]] + trajs[owner[i]] for every pair i, where
+        `trajs` holds equally long trajectories as a (m, L, 2) array.
+        """
+        rgs = np.empty(len(which))
+        for i in range(0, len(which), self.block):
+            nodes = self.coords[which[i:i + self.block]]
+            locs = trajs[owner[i:i + self.block]]
+            # Each row holds one candidate followed by the trajectory
+            lons = np.empty((len(nodes), locs.shape[1] + 1))
+            lats = np.empty((len(nodes), locs.shape[1] + 1))
+            lons[:, 0], lons[:, 1:] = nodes[:, 0], locs[:, :, 0]
+            lats[:, 0], lats[:, 1:] = nodes[:, 1], locs[:, :, 1]
+            clon = lons.mean(axis=1)[:, np.newaxis]
+            clat = lats.mean(axis=1)[:, np.newaxis]
+            rgs[i:i + self.block] = greate_circle_distance(clon, clat, lons, lats).mean(axis=1)
+        return rgs
+
+    def candidates(self, curlocs, rg):
+        """ Indices of the nodes that keep R_g within `rg`.
+        """
+        locs = np.array(curlocs, dtype=np.float64).reshape(1, -1, 2)
+        return self.candidates_many(locs, [rg])[1]
+
+    def candidates_many(self, trajs, rgs):
+        """ Candidates of many equally long trajectories at once, given as a
+        (m, L, 2) array with one R_g bound each, as flattened (trajectory
+        number, node index) pairs sorted by trajectory then node.
+
+        Adding node k to L points with centroid c and distance sum S moves
+        the centroid to c', with d(c', k) = L / (L + 1) * d(c, k) and
+        d(c', c) = d(c, k) / (L + 1). Since the mean distance to a point
+        set is at least the distance to its centroid, and by the triangle
+        inequality, 2L / (L + 1) * d(c, k) <= (L + 1) * R_g <=
+        S + 2L / (L + 1) * d(c, k). Nodes beyond the lower bound are
+        skipped and nodes within the upper bound taken, both with 10%
+        slack for the lon/lat approximation, so the exact test runs only
+        on the band between them.
+        """
+        trajs = np.asarray(trajs, np.float64)
+        rgs = np.asarray(rgs, np.float64)
+        n = trajs.shape[1]
+        centers = trajs.mean(axis=1)
+        owner, which, dist = self.index.query_radius_many(
+            centers[:, 0], centers[:, 1], 1.1 * rgs * (n + 1) ** 2 / (2 * n), return_distance=True)
+        sums = greate_circle_distance(centers[:, 0:1], centers[:, 1:2],
+                                      trajs[:, :, 0], trajs[:, :, 1]).sum(axis=1)
+        keep = sums[owner] + 2.2 * n / (n + 1) * dist <= (n + 1) * rgs[owner]
+        band = np.flatnonzero(~keep)
+        keep[band] = self.rg_with_many(trajs, owner[band], which[band]) <= rgs[owner[band]]
+        # Pairs come grouped by trajectory; order each group by node
+        keys = np.sort(owner[keep] * len(self.coords) + which[keep])
+        return keys // len(self.coords), keys % len(self.coords)
+
+    def __call__(self, curlocs, rg):
+        return [self.nodes[i] for i in self.candidates(curlocs, rg)]
+
+
+class RandomPolicy(object):
+    """ Move to a random candidate, or give up when there is none.
+    """
+
+    def __call__(self, candidates, traj, home, coords, rng):
+        if len(candidates) == 0:
+            return None
+        return candidates[rng.randint(len(candidates))]
+
+    def batch(self, owner, candidates, trajs, homes, coords, rngs):
+        counts = np.bincount(owner, minlength=len(rngs))
+        starts = np.cumsum(counts) - counts
+        nextlocs = np.full(len(rngs), -1, np.int64)
+        for i, rng in enumerate(rngs):
+            if counts[i]:
+                nextlocs[i] = candidates[starts[i] + rng.randint(counts[i])]
+        return nextlocs
+
+
+def farthest(coords, candidates, current, table=None):
+    """ The candidate farthest from node `current`, ignoring `current`
+    itself, as (index, distance); (-1, 0) when there is none. Distances
+    are read from a node x node `table` when given (anything supporting
+    table[rows, cols], e.g. a memory-mapped array), otherwise computed in
+    one vectorized call. Ties go to the first candidate.
+    """
+    candidates = np.asarray(candidates, np.int64)
+    nextlocs, dist = farthest_many(coords, np.zeros(len(candidates), np.int64),
+                                   candidates, [current], table)
+    return nextlocs[0], dist[0]
+
+
+def farthest_many(coords, owner, candidates, current, table=None):
+    """ :func:`farthest` for many agents at once, given flattened (agent
+    number, candidate) pairs and the current node of each agent, as
+    arrays of indices and distances.
+    """
+    owner, candidates = np.asarray(owner, np.int64), np.asarray(candidates, np.int64)
+    current = np.asarray(current, np.int64)
+    keep = candidates != current[owner]
+    owner, cands = owner[keep], candidates[keep]
+    frm = current[owner]
+    if table is not None:
+        dist = np.asarray(table[frm, cands])
+    else:
+        dist = greate_circle_distance(coords[cands, 0], coords[cands, 1],
+                                      coords[frm, 0], coords[frm, 1])
+    nextlocs = np.full(len(current), -1, np.int64)
+    maxdist = np.zeros(len(current), dist.dtype)
+    # Per agent, the largest distance first and ties in candidate order
+    order = np.lexsort((np.arange(len(cands)), -dist, owner))
+    if len(order):
+        first = order[np.r_[True, owner[order][1:] != owner[order][:-1]]]
+        nextlocs[owner[first]] = cands[first]
+        maxdist[owner[first]] = dist[first]
+    return nextlocs, maxdist
+
+
+class MaxDistancePolicy(object):
+    """ Move to the candidate farthest from the current location, or back
+    home when no candidate is farther than zero.
+    """
+
+    def __init__(self, table=None):
+        self.table = table
+
+    def __call__(self, candidates, traj, home, coords, rng):
+        nextloc, dist = farthest(coords, candidates, traj[-1], self.table)
+        return nextloc if dist > 0 else home
+
+    def batch(self, owner, candidates, trajs, homes, coords, rngs):
+        nextlocs, dist = farthest_many(coords, owner, candidates, trajs[:, -1], self.table)
+        return np.where(dist > 0, nextlocs, homes)
+
+
+class Simulator(object):
+    """ Daily trajectories of synthetic agents over opportunity nodes.
+
+    `profile(rng, nnodes)` draws an agent's (home index, R_g, dwelling
+    times). The policy picks the next node index of many agents at once
+    with `policy.batch(owner, candidates, trajs, homes, coords, rngs)`,
+    where the candidates of agent i are candidates[owner == i] and trajs
+    is their (m, L) array of node indices, returning -1 to drop an agent.
+    Every agent draws from its own RandomState seeded with (seed, uid), so
+    results do not depend on how agents are split over chunks or processes.
+    """
+
+    def __init__(self, nodes, policy, profile, timebound=18, seed=0):
+        self.pmap = PersonMap(nodes)
+        self.policy = policy
+        self.profile = profile
+        self.timebound = timebound
+        self.seed = seed
+
+    def run_agent(self, uid):
+        """ Return (uid, rg, trajectory node indices, dwelling times), or
+        None when the policy gives up.
+        """
+        return self.run_agents([uid])[0]
+
+    def run_agents(self, uids):
+        """ :meth:`run_agent` for many agents, stepped together: each step
+        selects candidates and next nodes of all agents still moving in a
+        few array operations.
+        """
+        coords = self.pmap.coords
+        rngs = [np.random.RandomState([self.seed, uid]) for uid in uids]
+        profiles = [self.profile(rng, len(coords)) for rng in rngs]
+        homes = np.array([p[0] for p in profiles], np.int64)
+        rgs = np.array([p[1] for p in profiles], np.float64)
+        dts = [p[2] for p in profiles]
+
+        maxsteps = max([len(i) for i in dts] or [0])
+        trajs = np.empty((len(uids), maxsteps + 1), np.int64)
+        trajs[:, 0] = homes
+        lengths = np.ones(len(uids), np.int64)
+        traj_dts = [[6] for _ in uids]
+        acctime = [0] * len(uids)
+        dropped = np.zeros(len(uids), bool)
+
+        active = range(len(uids))
+        for step in range(maxsteps):
+            active = [i for i in active if step < len(dts[i]) and acctime[i] < self.timebound]
+            if not active:
+                break
+            for i in active:
+                dt = min(dts[i][step], self.timebound - acctime[i])
+                traj_dts[i].append(dt)
+                acctime[i] += dt
+
+            active = np.array(active)
+            paths = trajs[active, :step + 1]
+            owner, candidates = self.pmap.candidates_many(coords[paths], rgs[active])
+            nextlocs = self.policy.batch(owner, candidates, paths, homes[active], coords,
+                                         [rngs[i] for i in active])
+            dropped[active[nextlocs < 0]] = True
+            active = active[nextlocs >= 0]
+            trajs[active, step + 1] = nextlocs[nextlocs >= 0]
+            lengths[active] += 1
+            active = active.tolist()
+
+        results = []
+        for i, uid in enumerate(uids):
+            if dropped[i]:
+                results.append(None)
+                continue
+            traj = trajs[i, :lengths[i]].tolist() + [int(homes[i])]
+            results.append((uid, rgs[i], traj, traj_dts[i] + [0]))
+        return results
+
+    def format_agent(self, uid):
+        """ Tab separated uid, R_g, number of locations, travel distance
+        and hop distances of one agent; empty for dropped agents.
+        """
+        return self.format_agents([uid])
+
+    def format_agents(self, uids):
+        """ :meth:`format_agent` rows of many agents, run together.
+        """
+        rows = []
+        for res in self.run_agents(uids):
+            if res is None:
+                continue
+            uid, rg, traj, _ = res
+            trvdist = hop_distances(self.pmap.coords[traj])
+            rows.append('%d\t%.3f\t%d\t%.3f\t%s\n' % (
+                uid, rg, len(set(traj)), np.sum(trvdist),
+                ','.join(['%.3f' % i for i in trvdist])))
+        return ''.join(rows)
+
+
+_simulator = None
+
+
+def _init_worker(simulator):
+    global _simulator
+    _simulator = simulator
+
+
+def _run_chunk(uids):
+    return _simulator.format_agents(uids)
+
+
+def simulate(simulator, uids, ofname, nproc=None, chunk_size=100, buffering=1 << 20):
+    """ Run agents in chunks over a process pool and stream their rows to
+    `ofname` in uid order through a buffered file.
+    """
+    uids = list(uids)
+    chunks = [uids[i:i + chunk_size] for i in range(0, len(uids), chunk_size)]
+    ofile = open(ofname, 'wb', buffering)
+    if nproc == 1:
+        _init_worker(simulator)
+        for chunk in chunks:
+            ofile.write(_run_chunk(chunk))
+    else:
+        pool = Pool(nproc or cpu_count(), _init_worker, (simulator,))
+        try:
+            for rows in pool.imap(_run_chunk, chunks):
+                ofile.write(rows)
+        finally:
+            pool.close()
+            pool.join()
+    ofile.close()
+
+
+def save_features(path, uid, rg, totloc, totdist, hops, offsets):
+    """ Write per-user trajectory features as columns of an npz file.
+    Hop distances of user i are hops[offsets[i]:offsets[i+1]].
+    """
+    np.savez(path, uid=np.asarray(uid, np.int64), rg=np.asarray(rg, np.float64),
+             totloc=np.asarray(totloc, np.int64), totdist=np.asarray(totdist, np.float64),
+             hops=np.asarray(hops, np.float64), offsets=np.asarray(offsets, np.int64))
+
+
+def load_features(path):
+    """ Read trajectory features written by :func:`save_features`, or the
+    tab separated rows of :func:`simulate`, as a dict of columns.
+    """
+    if path.endswith('.npz'):
+        data = np.load(path)
+        return dict((k, data[k]) for k in data.files)
+
+    cols = {'uid': [], 'rg': [], 'totloc': [], 'totdist': [], 'hops': [], 'offsets': [0]}
+    for line in open(path, 'rb'):
+        uid, rg, totloc, totdist, hops = line.rstrip('\r\n').split('\t')
+        cols['uid'].append(int(uid))
+        cols['rg'].append(float(rg))
+        cols['totloc'].append(int(totloc))
+        cols['totdist'].append(float(totdist))
+        hops = [float(i) for i in hops.split(',') if i]
+        cols['hops'].extend(hops)
+        cols['offsets'].append(cols['offsets'][-1] + len(hops))
+    types = {'uid': np.int64, 'totloc': np.int64, 'offsets': np.int64}
+    return dict((k, np.array(v, types.get(k, np.float64))) for k, v in cols.items())
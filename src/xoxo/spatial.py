@@ -0,0 +1,154 @@
+# Copyright (C) 2015, Xiaming Chen chen@xiaming.me
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import math
+
+import numpy as np
+
+from geo import EARTH_R, greate_circle_distance
+
+
+__all__ = ['SpatialIndex']
+
+
+class SpatialIndex(object):
+    """ A uniform lon/lat grid over weighted points for radius and annulus
+    queries in km.
+
+    Points are sorted by cell so that every grid row touched by a query is
+    one contiguous slice found by binary search. Candidates from the
+    bounding box are filtered with the exact great circle distance, so
+    results equal a brute force scan with :func:`greate_circle_distance`.
+    """
+
+    def __init__(self, coordinates, weights=None, cell_km=1.0):
+        coords = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+        n = len(coords)
+        weights = np.ones(n) if weights is None else np.asarray(weights, dtype=np.float64)
+        assert len(weights) == n
+
+        lat0 = np.mean(coords[:, 1]) if n > 0 else 0.0
+        self.cell_lat = math.degrees(cell_km / EARTH_R)
+        self.cell_lon = self.cell_lat / max(math.cos(math.radians(lat0)), 1e-6)
+        self.lon0 = coords[:, 0].min() if n > 0 else 0.0
+        self.lat0 = coords[:, 1].min() if n > 0 else 0.0
+
+        ix, iy = self._cell(coords[:, 0], coords[:, 1])
+        self.nx = int(ix.max()) + 1 if n > 0 else 1
+        self.ny = int(iy.max()) + 1 if n > 0 else 1
+        keys = ix * self.ny + iy
+        order = np.argsort(keys, kind='mergesort')
+
+        self.index = order
+        self.keys = keys[order]
+        self.lons = coords[order, 0]
+        self.lats = coords[order, 1]
+        self.weights = weights[order]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _cell(self, lons, lats):
+        ix = np.floor((lons - self.lon0) / self.cell_lon).astype(np.int64)
+        iy = np.floor((lats - self.lat0) / self.cell_lat).astype(np.int64)
+        return ix, iy
+
+    def _candidates(self, lon, lat, r):
+        """ Sorted positions of the points in the bounding box of a circle.
+        """
+        dlat = math.degrees(r / EARTH_R)
+        s = math.sin(r / EARTH_R) / max(math.cos(math.radians(lat)), 1e-12)
+        dlon = 180.0 if s >= 1 or abs(lat) + dlat >= 90 else math.degrees(math.asin(s))
+        # A small pad keeps points on the bounding box edge despite rounding.
+        dlat += 1e-9
+        dlon += 1e-9
+
+        ix0, iy0 = self._cell(lon - dlon, lat - dlat)
+        ix1, iy1 = self._cell(lon + dlon, lat + dlat)
+        ix0, iy0 = max(int(ix0), 0), max(int(iy0), 0)
+        ix1, iy1 = min(int(ix1), self.nx - 1), min(int(iy1), self.ny - 1)
+        if ix0 > ix1 or iy0 > iy1:
+            return np.zeros(0, np.int64)
+
+        rows = np.arange(ix0, ix1 + 1) * self.ny
+        starts = np.searchsorted(self.keys, rows + iy0, side='left')
+        ends = np.searchsorted(self.keys, rows + iy1, side='right')
+        return np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)])
+
+    def query_radius(self, lon, lat, r, return_distance=False):
+        """ Indices (into the input coordinates) of points within `r` km of
+        (lon, lat), boundary included.
+        """
+        cand = self._candidates(lon, lat, r)
+        dist = greate_circle_distance(lon, lat, self.lons[cand], self.lats[cand])
+        mask = dist <= r
+        if return_distance:
+            return self.index[cand[mask]], dist[mask]
+        return self.index[cand[mask]]
+
+    def query_radius_many(self, lons, lats, r, return_distance=False):
+        """ :meth:`query_radius` for a batch of query points, as flattened
+        (query number, point index) pairs in query order.
+        """
+        lons, lats, r = [np.ravel(i) for i in np.broadcast_arrays(
+            np.asarray(lons, np.float64), np.asarray(lats, np.float64), np.asarray(r, np.float64))]
+        query, cand, dist = self._gather(lons, lats, r)
+        mask = dist <= r[query]
+        if return_distance:
+            return query[mask], self.index[cand[mask]], dist[mask]
+        return query[mask], self.index[cand[mask]]
+
+    def _gather(self, lons, lats, outer):
+        """ Candidate positions and their distances for a batch of queries,
+        flattened with the query number of each candidate.
+        """
+        parts = [self._candidates(lon, lat, r) for lon, lat, r in zip(lons, lats, outer)]
+        query = np.repeat(np.arange(len(parts)), [len(p) for p in parts])
+        cand = np.concatenate(parts) if parts else np.zeros(0, np.int64)
+        dist = greate_circle_distance(lons[query], lats[query], self.lons[cand], self.lats[cand])
+        return query, cand, dist
+
+    def annulus_stats(self, lons, lats, inner, outer):
+        """ For each query point, the count, weight sum and weight maximum
+        of points with `inner <= distance <= outer` km. The maximum of an
+        empty annulus is NaN.
+        """
+        lons, lats, inner, outer = np.broadcast_arrays(
+            np.asarray(lons, np.float64), np.asarray(lats, np.float64),
+            np.asarray(inner, np.float64), np.asarray(outer, np.float64))
+        lons, lats, inner, outer = [np.ravel(i) for i in (lons, lats, inner, outer)]
+        nq = len(lons)
+
+        query, cand, dist = self._gather(lons, lats, outer)
+        mask = (dist >= inner[query]) & (dist <= outer[query])
+        query = query[mask]
+        weight = self.weights[cand[mask]]
+
+        count = np.bincount(query, minlength=nq)
+        total = np.bincount(query, weights=weight, minlength=nq)
+        wmax = np.full(nq, -np.inf)
+        np.maximum.at(wmax, query, weight)
+        wmax[count == 0] = np.nan
+        return count, total, wmax
+
+    def radius_stats(self, lons, lats, radii):
+        """ Count, weight sum and weight maximum of points within `radii` km
+        of each query point, see :meth:`annulus_stats`.
+        """
+        return self.annulus_stats(lons, lats, -np.inf, radii)
@@ -23,15 +23,21 @@ import zipfile
 import fnmatch
 import random
 import string
+import struct
+import numbers
 
 import shapefile
 import numpy as np
 import networkx as nx
 import matplotlib.pyplot as plt
 
+from mobgraph import MobGraph
+from geo import greate_circle_distance, hop_distances, path_length
 
 __all__ = ['drange', 'in_area', 'seq2graph', 'greate_circle_distance', 'shape2points',
-           'randstr', 'zipdir', 'zippylib']
+           'randstr', 'zipdir', 'zippylib', 'RgAccumulator', 'radius_of_gyration',
+           'hop_distances', 'travel_distance', 'radius_of_gyration_batch',
+           'travel_distance_batch']
 
 try:
     from matplotlib.patches import FancyArrowPatch, Circle
@@ -130,33 +136,87 @@ def draw_network(G, pos, ax):
     return e
 
 
-def greate_circle_distance(lon0, lat0, lon1, lat1):
-    """Return the distance (in km) between two points in
-    geographical coordinates.
-    """
-    EARTH_R = 6372.8
-    lat0 = np.radians(lat0)
-    lon0 = np.radians(lon0)
-    lat1 = np.radians(lat1)
-    lon1 = np.radians(lon1)
-    dlon = lon0 - lon1
-    y = np.sqrt(
-        (np.cos(lat1) * np.sin(dlon)) ** 2
-        + (np.cos(lat0) * np.sin(lat1)
-           - np.sin(lat0) * np.cos(lat1) * np.cos(dlon)) ** 2)
-    x = np.sin(lat0) * np.sin(lat1) + \
-        np.cos(lat0) * np.cos(lat1) * np.cos(dlon)
-    c = np.arctan2(y, x)
-    return EARTH_R * c
+def _as_lonlat(coordinates):
+    return np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
 
 
 def radius_of_gyration(coordinates):
     """ Calculate the radius of gyration given a list of [(lons, lats)]
+    or an (n, 2) array.
+    """
+    coords = _as_lonlat(coordinates)
+    clon, clat = coords.mean(axis=0)
+    return np.mean(greate_circle_distance(clon, clat, coords[:, 0], coords[:, 1]))
+
+
+def travel_distance(coordinates):
+    """ Total distance travelled along a sequence of coordinates.
+    """
+    return path_length(coordinates)
+
+
+def _segments(offsets):
+    offsets = np.asarray(offsets, dtype=np.int64)
+    counts = np.diff(offsets)
+    return np.repeat(np.arange(len(counts)), counts), counts
+
+
+def radius_of_gyration_batch(coordinates, offsets):
+    """ Radius of gyration of many users at once. Points of user i are
+    coordinates[offsets[i]:offsets[i+1]]; users without points get NaN.
     """
-    clon = np.average([coord[0] for coord in coordinates])
-    clat = np.average([coord[1] for coord in coordinates])
+    coords = _as_lonlat(coordinates)
+    seg, counts = _segments(offsets)
+    k = len(counts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        clon = np.bincount(seg, coords[:, 0], k) / counts
+        clat = np.bincount(seg, coords[:, 1], k) / counts
+        dist = greate_circle_distance(clon[seg], clat[seg], coords[:, 0], coords[:, 1])
+        return np.bincount(seg, dist, k) / counts
+
+
+def travel_distance_batch(coordinates, offsets):
+    """ Total travel distance of many users at once, with the same layout
+    as :func:`radius_of_gyration_batch`.
+    """
+    coords = _as_lonlat(coordinates)
+    seg, counts = _segments(offsets)
+    same = seg[:-1] == seg[1:]
+    dist = hop_distances(coords)[same]
+    return np.bincount(seg[:-1][same], dist, len(counts))
+
 
-    return np.average([greate_circle_distance(clon, clat, coord[0], coord[1]) for coord in coordinates])
+class RgAccumulator(object):
+    """ Radius of gyration of a growing set of coordinates.
+
+    Points are kept as distinct coordinates with visit counts plus running
+    coordinate sums, so adding a day costs O(new points) and memory grows
+    only with the number of distinct locations. :meth:`value` equals
+    :func:`radius_of_gyration` over all points added so far.
+    """
+
+    def __init__(self):
+        self.visits = {}
+        self.total = 0
+        self.sum_lon = 0.0
+        self.sum_lat = 0.0
+
+    def add(self, coordinates):
+        for coord in coordinates:
+            self.visits[coord] = self.visits.get(coord, 0) + 1
+            self.sum_lon += coord[0]
+            self.sum_lat += coord[1]
+        self.total += len(coordinates)
+
+    def value(self):
+        if self.total == 0:
+            return np.nan
+        coords = np.array(self.visits.keys(), dtype=np.float64)
+        counts = np.array(self.visits.values(), dtype=np.float64)
+        clon = self.sum_lon / self.total
+        clat = self.sum_lat / self.total
+        dist = greate_circle_distance(clon, clat, coords[:, 0], coords[:, 1])
+        return np.dot(counts, dist) / self.total
 
 
 def shape2points(shpfile):
@@ -220,8 +280,10 @@ def normalized(a, axis=None, order=2):
 
 
 def dumps_mobgraph(G, node_attribute='weight', edge_attribute='weight', norm=True):
-    """ Save a mobility graph to string
+    """ Save a mobility graph (DiGraph or MobGraph) to string
     """
+    if isinstance(G, MobGraph):
+        G = G.to_networkx(node_attribute, edge_attribute)
     assert isinstance(G, nx.DiGraph)
     nw = []
     ew = []
@@ -267,3 +329,157 @@ def loads_mobgraph(S, node_attribute='weight', edge_attribute='weight'):
         G.node[et][node_attribute] = ntw
 
     return G
+
+
+_MG_MAGIC = b'MG'
+_MG_VERSION = 2
+_MG_BATCH_MAGIC = b'MGB\x02'
+_MG_BATCH_MAGICS = (b'MGB\x01', _MG_BATCH_MAGIC)
+_MG_HEADER = struct.Struct('<2sBBBII')
+_MG_HEADER_V1 = struct.Struct('<2sBBII')
+_MG_BATCH_HEADER = struct.Struct('<4sI')
+_MG_NODE_COORD = 0
+_MG_NODE_INT = 1
+
+
+def _mg_node_kind(nodes):
+    if all(isinstance(n, tuple) and len(n) == 2 for n in nodes):
+        return _MG_NODE_COORD
+    if all(isinstance(n, (numbers.Integral, np.integer)) for n in nodes):
+        return _MG_NODE_INT
+    raise TypeError('Binary codec supports (lon, lat) or integer nodes only')
+
+
+def _mg_index_dtype(nnode):
+    for dt in ('<u1', '<u2', '<u4'):
+        if nnode <= np.iinfo(dt).max + 1:
+            return np.dtype(dt)
+    raise ValueError('Too many nodes for binary codec: %d' % nnode)
+
+
+def dumpb_mobgraph(G, node_attribute='weight', edge_attribute='weight', norm=False):
+    """ Save a mobility graph to a compact binary string.
+
+    Layout (little endian): a 13-byte header (magic, format version, node
+    kind, index width, number of nodes, number of edges), then node ids
+    (float64 lon/lat pairs or int64), node weights (float64), edge source
+    and target indices (uint8/16/32 depending on the number of nodes), edge
+    weights (float64) and edge frequencies (int32). Missing weights are
+    stored as NaN and dropped again on loading; missing frequencies count 1.
+    `G` may be a networkx DiGraph or a :class:`MobGraph`.
+    """
+    if not isinstance(G, MobGraph):
+        assert isinstance(G, nx.DiGraph)
+        _mg_node_kind(G.nodes())
+        G = MobGraph.from_networkx(G, node_attribute, edge_attribute)
+    kind = _MG_NODE_COORD if G.is_coordinate() else _MG_NODE_INT
+    nn = G.number_of_nodes()
+    ne = G.number_of_edges()
+
+    nw = G.node_weight
+    ew = G.edge_weight
+    if norm:
+        if nn > 0:
+            nw = nw / np.nansum(nw)
+        if ne > 0:
+            ew = ew / np.nansum(ew)
+
+    idx = _mg_index_dtype(nn)
+    return b''.join([
+        _MG_HEADER.pack(_MG_MAGIC, _MG_VERSION, kind, idx.itemsize, nn, ne),
+        G.nodes.astype('<f8' if kind == _MG_NODE_COORD else '<i8').tostring(),
+        nw.astype('<f8').tostring(),
+        G.src.astype(idx).tostring(),
+        G.dst.astype(idx).tostring(),
+        ew.astype('<f8').tostring(),
+        G.edge_freq.astype('<i4').tostring()])
+
+
+def _mg_unpack_arrays(S, offset=0):
+    """ Decode one binary mobility graph starting at `offset` into
+    (kind, node ids, node weights, sources, targets, edge weights, edge
+    frequencies, end).
+    """
+    # Version 1 had no version byte, its third byte is the node kind (0 or 1)
+    if struct.unpack_from('<B', S, offset + 2)[0] < _MG_VERSION:
+        magic, kind, isize, nn, ne = _MG_HEADER_V1.unpack_from(S, offset)
+        version = 1
+        pos = offset + _MG_HEADER_V1.size
+    else:
+        magic, version, kind, isize, nn, ne = _MG_HEADER.unpack_from(S, offset)
+        pos = offset + _MG_HEADER.size
+    if magic != _MG_MAGIC or version > _MG_VERSION:
+        raise ValueError('Not a binary mobility graph')
+    if kind == _MG_NODE_COORD:
+        nid = np.frombuffer(S, '<f8', 2 * nn, pos).reshape(nn, 2)
+        pos += 16 * nn
+    elif kind == _MG_NODE_INT:
+        nid = np.frombuffer(S, '<i8', nn, pos)
+        pos += 8 * nn
+    else:
+        raise ValueError('Unknown node kind %d' % kind)
+    nw = np.frombuffer(S, '<f8', nn, pos); pos += 8 * nn
+    idx = '<u%d' % isize
+    es = np.frombuffer(S, idx, ne, pos); pos += isize * ne
+    et = np.frombuffer(S, idx, ne, pos); pos += isize * ne
+    ew = np.frombuffer(S, '<f8', ne, pos); pos += 8 * ne
+    if version == 1:
+        ef = np.ones(ne, np.int32)
+    else:
+        ef = np.frombuffer(S, '<i4', ne, pos); pos += 4 * ne
+    return kind, nid, nw, es, et, ew, ef, pos
+
+
+def _mg_build_graph(kind, nid, nw, es, et, ew, ef, node_attribute, edge_attribute, compact):
+    if compact:
+        return MobGraph(nid, nw, es, et, ew, ef)
+    if kind == _MG_NODE_COORD:
+        nodes = [tuple(i) for i in nid.tolist()]
+    else:
+        nodes = nid.tolist()
+    nw = [{} if np.isnan(w) else {node_attribute: w} for w in nw.tolist()]
+    ew = [{'frequency': f} if np.isnan(w) else {edge_attribute: w, 'frequency': f}
+          for w, f in zip(ew.tolist(), ef.tolist())]
+
+    G = nx.DiGraph()
+    G.add_nodes_from(zip(nodes, nw))
+    G.add_edges_from((nodes[s], nodes[t], w)
+                     for s, t, w in zip(es.tolist(), et.tolist(), ew))
+    return G
+
+
+def loadb_mobgraph(S, node_attribute='weight', edge_attribute='weight', compact=False):
+    """ Load a mobility graph from its binary representation, as a
+    :class:`MobGraph` if `compact` is True and a networkx DiGraph otherwise.
+    """
+    arrays = _mg_unpack_arrays(S)[:-1]
+    return _mg_build_graph(*(arrays + (node_attribute, edge_attribute, compact)))
+
+
+def dumpb_mobgraphs(graphs, node_attribute='weight', edge_attribute='weight', norm=False):
+    """ Save a sequence of mobility graphs into one binary buffer.
+
+    The buffer holds a header with the number of graphs, a uint64 offset
+    table and the concatenated payloads of :func:`dumpb_mobgraph`.
+    """
+    payloads = [dumpb_mobgraph(G, node_attribute, edge_attribute, norm) for G in graphs]
+    offsets = np.zeros(len(payloads) + 1, dtype='<u8')
+    offsets[1:] = np.cumsum([len(p) for p in payloads])
+    return b''.join([_MG_BATCH_HEADER.pack(_MG_BATCH_MAGIC, len(payloads)),
+                     offsets.tostring()] + payloads)
+
+
+def loadb_mobgraphs(S, node_attribute='weight', edge_attribute='weight', compact=False):
+    """ Load all mobility graphs from a buffer made by :func:`dumpb_mobgraphs`
+    """
+    magic, count = _MG_BATCH_HEADER.unpack_from(S, 0)
+    if magic not in _MG_BATCH_MAGICS:
+        raise ValueError('Not a binary mobility graph batch')
+    base = _MG_BATCH_HEADER.size + 8 * (count + 1)
+    offsets = np.frombuffer(S, '<u8', count + 1, _MG_BATCH_HEADER.size)
+    graphs = []
+    for start in offsets[:-1].tolist():
+        arrays = _mg_unpack_arrays(S, base + start)[:-1]
+        graphs.append(_mg_build_graph(*(arrays + (node_attribute, edge_attribute, compact))))
+    return graphs
+